@@ -1,10 +1,6 @@
 import streamlit as st
-import pandas as pd
-import gspread
-from google.oauth2.service_account import Credentials
-from google_auth_oauthlib.flow import Flow
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
+import importlib
+import sys
 import base64
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
@@ -12,14 +8,71 @@ import datetime
 import time
 import socket
 import re
+import random
+import threading
+import sqlite3
+import pickle
+import os
+import tempfile
+import itertools
+import bisect
+import html
+import hashlib
+from email.utils import getaddresses
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 
 # ==========================================
-# 0. CONFIG & NETWORK SAFETY
+# 0. LAZY IMPORTS
 # ==========================================
-socket.setdefaulttimeout(30)
-st.set_page_config(page_title="Kohani CRM", page_icon="📊", layout="wide")
+# The Google client libraries and pandas take well over a second to import on a fresh
+# process. None of them are needed to draw the login page, so they load on first use.
+# Budgets are per module, in ms; the admin sidebar flags anything that goes over. A module
+# that an earlier one already imported (google.auth.transport.requests comes in with the
+# OAuth flow) costs nothing by itself, so it has no budget of its own.
+IMPORT_BUDGET_MS = {
+    "pandas": 800,
+    "gspread": 400,
+    "google.oauth2.service_account": 250,
+    "google_auth_oauthlib.flow": 400,
+    "googleapiclient.discovery": 400,
+    "pyarrow": 300,
+    "pyarrow.parquet": 150,
+}
+
+@st.cache_resource
+def get_import_costs():
+    return {}
+
+class LazyModule:
+    """Stands in for a module until an attribute is first used, then imports it and records the cost."""
+    def __init__(self, name):
+        self._name = name
+        self._module = None
 
-st.markdown("""
+    def __getattr__(self, attr):
+        if self._module is None:
+            if self._name in sys.modules:
+                self._module = sys.modules[self._name]
+            else:
+                start = time.perf_counter()
+                self._module = importlib.import_module(self._name)
+                get_import_costs()[self._name] = (time.perf_counter() - start) * 1000
+        return getattr(self._module, attr)
+
+pd = LazyModule("pandas")
+gspread = LazyModule("gspread")
+service_account = LazyModule("google.oauth2.service_account")
+oauth_flow = LazyModule("google_auth_oauthlib.flow")
+google_requests = LazyModule("google.auth.transport.requests")
+discovery = LazyModule("googleapiclient.discovery")
+pa = LazyModule("pyarrow")
+pq = LazyModule("pyarrow.parquet")
+
+# ==========================================
+# 1. CONFIG & NETWORK SAFETY
+# ==========================================
+APP_CSS = """
     <style>
     #MainMenu {display: none;}
     header {visibility: hidden;}
@@ -45,25 +98,31 @@ st.markdown("""
     .email-snippet { font-size: 0.9em; color: #333; }
     .warning-box { background-color: #fff3cd; color: #856404; padding: 10px; border-radius: 5px; }
     </style>
-    """, unsafe_allow_html=True)
+"""
+
+socket.setdefaulttimeout(30)
+st.set_page_config(page_title="Kohani CRM", page_icon="📊", layout="wide")
+
+# Streamlit rebuilds the page on every rerun, so the styles have to be re-sent each time
+st.markdown(APP_CSS, unsafe_allow_html=True)
 
 # Admin Email for CC
 ADMIN_EMAIL = "ali@kohani.com"
 
-SCOPES = [
+SCOPES = (
     'https://www.googleapis.com/auth/gmail.send',
     'https://www.googleapis.com/auth/gmail.readonly', # Required for reading history
     'https://www.googleapis.com/auth/gmail.settings.basic',
     'openid',
     'https://www.googleapis.com/auth/userinfo.email',
     'https://www.googleapis.com/auth/userinfo.profile'
-]
+)
 
 # ==========================================
-# 1. AUTHENTICATION
+# 2. AUTHENTICATION
 # ==========================================
 def get_auth_flow():
-    return Flow.from_client_config(
+    return oauth_flow.Flow.from_client_config(
         {
             "web": {
                 "client_id": st.secrets["client"]["client_id"],
@@ -73,7 +132,7 @@ def get_auth_flow():
                 "redirect_uris": [st.secrets["client"]["redirect_uri"]]
             }
         },
-        scopes=SCOPES,
+        scopes=list(SCOPES),
         redirect_uri=st.secrets["client"]["redirect_uri"]
     )
 
@@ -85,7 +144,7 @@ def authenticate_user():
             flow.fetch_token(code=code)
             st.session_state.creds = flow.credentials
             
-            user_info_service = build('oauth2', 'v2', credentials=st.session_state.creds)
+            user_info_service = discovery.build('oauth2', 'v2', credentials=st.session_state.creds)
             user_info = user_info_service.userinfo().get().execute()
             
             st.session_state.user_email = user_info.get('email')
@@ -100,7 +159,7 @@ def authenticate_user():
     if "creds" in st.session_state:
         if st.session_state.creds.expired and st.session_state.creds.refresh_token:
             try:
-                st.session_state.creds.refresh(Request())
+                st.session_state.creds.refresh(google_requests.Request())
             except:
                 del st.session_state.creds
                 return False
@@ -108,16 +167,131 @@ def authenticate_user():
     return False
 
 # ==========================================
-# 2. GMAIL FUNCTIONS
+# 3. GOOGLE API LAYER (QUOTAS & RETRIES)
+# ==========================================
+# Every Sheets/Gmail call goes through call_api(). Sheets runs as one service account, so
+# its limits are shared by all sessions and a busy call block backs off together. Gmail
+# quota is per user, so Gmail endpoints get one bucket per user (pass user=).
+API_LIMITS = {                  # endpoint: (requests per second, burst)
+    "sheets_read": (1.0, 10),   # Sheets allows 60 reads/min per user
+    "sheets_write": (1.0, 5),
+    "gmail_read": (10.0, 25),
+    "gmail_send": (2.0, 5),
+    "gmail_sync": (5.0, 10),    # background index sync, kept apart from interactive reads
+    "gmail_batch": (0.5, 1),    # index sync metadata batches; 100 gets = 500 of the 250 units/s per user
+}
+API_MAX_RETRIES = 5
+API_BASE_BACKOFF = 1.0   # seconds, doubled per attempt
+API_MAX_BACKOFF = 32.0
+REFRESH_COOLDOWN = 30    # seconds between manual "Refresh Data" reloads
+STALE_KEEP = 200         # remembered Gmail searches to fall back on
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class SingleFlight:
+    """Runs one call per key at a time; concurrent callers with the same key share its result."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader: call = self.calls[key] = {'done': threading.Event(), 'result': None, 'error': None}
+        if not leader:
+            call['done'].wait()
+            if call['error'] is not None: raise call['error']
+            return call['result']
+        try:
+            call['result'] = fn()
+            return call['result']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self.lock: del self.calls[key]
+            call['done'].set()
+
+@st.cache_resource
+def get_api_state():
+    return {
+        'buckets': {},
+        'lock': threading.Lock(),
+        'flight': SingleFlight(),
+        'last_good': {},
+        'last_refresh': 0.0,
+    }
+
+def api_error_status(e):
+    # gspread errors carry a requests.Response, googleapiclient errors an httplib2 response.
+    # Compare against None: a requests.Response with a 4xx/5xx status is falsy.
+    resp = getattr(e, 'response', None)
+    if resp is None: resp = getattr(e, 'resp', None)
+    status = getattr(resp, 'status_code', None)
+    if status is None: status = getattr(resp, 'status', None)
+    if status is None: status = getattr(e, 'code', None)  # gspread APIError.code
+    try: return int(status)
+    except (TypeError, ValueError): return None
+
+def get_bucket(endpoint, user=None):
+    state = get_api_state()
+    key = (endpoint, user.lower()) if user else endpoint
+    with state['lock']:
+        if key not in state['buckets']: state['buckets'][key] = TokenBucket(*API_LIMITS[endpoint])
+        return state['buckets'][key]
+
+def call_api(endpoint, fn, retry_server_errors=True, user=None):
+    """
+    Runs fn() under the endpoint's rate limit, retrying 429s (and 5xx/network errors when
+    retry_server_errors) with exponential backoff and full jitter. Re-raises the last error.
+    Network errors are OSErrors: socket timeouts and requests' exceptions both derive from it.
+    """
+    bucket = get_bucket(endpoint, user)
+    for attempt in range(API_MAX_RETRIES + 1):
+        bucket.acquire()
+        try:
+            return fn()
+        except Exception as e:
+            status = api_error_status(e)
+            if status == 429: retryable = True
+            elif retry_server_errors: retryable = (status is not None and status >= 500) or isinstance(e, OSError)
+            else: retryable = False
+            if not retryable or attempt == API_MAX_RETRIES: raise
+            time.sleep(random.uniform(0, min(API_MAX_BACKOFF, API_BASE_BACKOFF * 2 ** attempt)))
+
+def coalesced(key, fn):
+    return get_api_state()['flight'].do(key, fn)
+
+# ==========================================
+# 4. GMAIL FUNCTIONS
 # ==========================================
 def get_gmail_service():
     if "creds" not in st.session_state: return None
-    return build('gmail', 'v1', credentials=st.session_state.creds)
+    return discovery.build('gmail', 'v1', credentials=st.session_state.creds)
 
 def get_user_signature():
     try:
         service = get_gmail_service()
-        sendas_list = service.users().settings().sendAs().list(userId='me').execute()
+        sendas_list = call_api("gmail_read", lambda: service.users().settings().sendAs().list(userId='me').execute(), user=st.session_state.user_email)
         for alias in sendas_list.get('sendAs', []):
             if alias.get('isPrimary') or alias.get('sendAsEmail') == st.session_state.user_email:
                 return alias.get('signature', '') 
@@ -125,27 +299,33 @@ def get_user_signature():
     except:
         return ""
 
+def get_session_signature():
+    # The signature rarely changes; fetch it once per session instead of on every render
+    if 'signature' not in st.session_state: st.session_state.signature = get_user_signature()
+    return st.session_state.signature
+
 def search_gmail_messages(query_emails):
     """
     Searches the logged-in user's Gmail.
     Returns: (list_of_emails, error_message)
     """
     if not query_emails: return [], "No email addresses to search."
-    try:
+    # Construct query: from:a@b.com OR to:a@b.com
+    q_parts = [f"from:{e} OR to:{e}" for e in query_emails if e and "@" in e]
+    if not q_parts: return [], "Invalid email format."
+    full_query = " OR ".join(q_parts)
+    user_email = st.session_state.user_email
+    cache_key = ("gmail_search", user_email, full_query)
+
+    def run_search():
         service = get_gmail_service()
-        # Construct query: from:a@b.com OR to:a@b.com
-        q_parts = [f"from:{e} OR to:{e}" for e in query_emails if e and "@" in e]
-        if not q_parts: return [], "Invalid email format."
-        
-        full_query = " OR ".join(q_parts)
-        
-        results = service.users().messages().list(userId='me', q=full_query, maxResults=10).execute()
+        results = call_api("gmail_read", lambda: service.users().messages().list(userId='me', q=full_query, maxResults=10).execute(), user=user_email)
         messages = results.get('messages', [])
         
         email_data = []
         if messages:
             for msg in messages:
-                m_detail = service.users().messages().get(userId='me', id=msg['id'], format='metadata').execute()
+                m_detail = call_api("gmail_read", lambda: service.users().messages().get(userId='me', id=msg['id'], format='metadata').execute(), user=user_email)
                 headers = m_detail.get('payload', {}).get('headers', [])
                 
                 subject = next((h['value'] for h in headers if h['name'] == 'Subject'), '(No Subject)')
@@ -157,11 +337,23 @@ def search_gmail_messages(query_emails):
                     'date': date_str,
                     'snippet': snippet
                 })
+        return email_data
+
+    last_good = get_api_state()['last_good']
+    try:
+        email_data = coalesced(cache_key, run_search)
+        last_good.pop(cache_key, None)
+        if len(last_good) >= STALE_KEEP: last_good.pop(next(iter(last_good)))
+        last_good[cache_key] = (email_data, datetime.datetime.now())
         return email_data, None
     except Exception as e:
         error_str = str(e)
-        if "403" in error_str or "insufficient" in error_str.lower():
+        if api_error_status(e) == 403 or "insufficient" in error_str.lower():
             return [], "PERM_ERROR"
+        if cache_key in last_good:
+            email_data, fetched_at = last_good[cache_key]
+            st.warning(f"⚠️ Gmail is busy right now. Showing results from {fetched_at:%H:%M}.")
+            return email_data, None
         return [], f"Gmail API Error: {error_str}"
 
 def send_email_as_user(to_email, subject, body_text, body_html):
@@ -186,19 +378,362 @@ def send_email_as_user(to_email, subject, body_text, body_html):
         raw = base64.urlsafe_b64encode(message.as_bytes()).decode()
         body = {'raw': raw}
         
-        service.users().messages().send(userId='me', body=body).execute()
+        # Only 429s are retried: a 5xx may already have sent the message
+        call_api("gmail_send", lambda: service.users().messages().send(userId='me', body=body).execute(), retry_server_errors=False, user=st.session_state.user_email)
         return True
     except Exception as e:
         st.error(f"Gmail Error: {e}")
         return False
 
 # ==========================================
-# 3. DATABASE FUNCTIONS & HELPERS
+# 5. SHARED CACHE (ACROSS REPLICAS)
+# ==========================================
+# Each worksheet has a version number in the shared store. update_data bumps it, and every
+# replica keys its local cache on the current version, so a save on one replica makes the
+# others reload just that sheet. Snapshots and derived indexes are stored per version.
+SNAPSHOT_TTL = 600  # seconds; also picks up edits made directly in Google Sheets
+CACHED_SHEETS = ["Clients", "Reference", "Templates"]
+
+class SharedCache(ABC):
+    """Backend interface. Values are stored under (sheet, name) and tagged with the sheet version."""
+    @abstractmethod
+    def version(self, sheet): ...
+
+    @abstractmethod
+    def bump(self, sheet): ...
+
+    @abstractmethod
+    def get(self, sheet, version, name, max_age=None): ...
+
+    @abstractmethod
+    def put(self, sheet, version, name, value): ...
+
+class SQLiteSharedCache(SharedCache):
+    """Local backend: one SQLite file, shared by every replica that can see the same path."""
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        conn = self.conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS versions (sheet TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS entries (sheet TEXT, name TEXT, version INTEGER, created REAL, value BLOB, PRIMARY KEY (sheet, name))")
+        conn.commit()
+
+    def conn(self):
+        # sqlite3 connections can't be shared between threads; Streamlit runs each session in its own
+        if getattr(self.local, 'conn', None) is None:
+            self.local.conn = sqlite3.connect(self.path, timeout=30)
+        return self.local.conn
+
+    def version(self, sheet):
+        row = self.conn().execute("SELECT version FROM versions WHERE sheet = ?", (sheet,)).fetchone()
+        return row[0] if row else 0
+
+    def bump(self, sheet):
+        conn = self.conn()
+        with conn:
+            conn.execute("INSERT INTO versions (sheet, version) VALUES (?, 1) ON CONFLICT(sheet) DO UPDATE SET version = version + 1", (sheet,))
+            return conn.execute("SELECT version FROM versions WHERE sheet = ?", (sheet,)).fetchone()[0]
+
+    def get(self, sheet, version, name, max_age=None):
+        row = self.conn().execute("SELECT version, created, value FROM entries WHERE sheet = ? AND name = ?", (sheet, name)).fetchone()
+        if not row or row[0] != version: return None
+        if max_age is not None and time.time() - row[1] > max_age: return None
+        return pickle.loads(row[2])
+
+    def put(self, sheet, version, name, value):
+        conn = self.conn()
+        with conn:
+            # Never let a slow writer overwrite a newer version's entry
+            conn.execute("INSERT INTO entries (sheet, name, version, created, value) VALUES (?, ?, ?, ?, ?) "
+                         "ON CONFLICT(sheet, name) DO UPDATE SET version = excluded.version, created = excluded.created, value = excluded.value "
+                         "WHERE excluded.version >= entries.version",
+                         (sheet, name, version, time.time(), pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)))
+
+def cache_dir():
+    """
+    Holds pickled snapshots, Gmail indexes and client exports. Cached values are unpickled
+    on read, so anyone who can write here can run code in the app: the directory must be
+    ours and closed to group/others.
+    """
+    path = st.secrets.get("cache", {}).get("dir") or os.path.join(tempfile.gettempdir(), "kohani_crm")
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.stat(path)
+    if hasattr(os, "getuid") and info.st_uid != os.getuid():
+        st.error(f"❌ Cache directory {path} is owned by another user. Set cache.dir to a private directory.")
+        st.stop()
+    if info.st_mode & 0o077: os.chmod(path, 0o700)  # Directories made before this check was added
+    return path
+
+@st.cache_resource
+def get_shared_cache():
+    return SQLiteSharedCache(os.path.join(cache_dir(), "shared_cache.sqlite3"))
+
+@st.cache_resource
+def get_derived_memo():
+    return {}
+
+def sheet_version(worksheet_name):
+    return get_shared_cache().version(worksheet_name)
+
+def publish_invalidation(worksheet_name, df=None):
+    """Bumps the sheet version so every replica reloads it, seeding the new snapshot when known."""
+    cache = get_shared_cache()
+    version = cache.bump(worksheet_name)
+    if df is not None: cache.put(worksheet_name, version, "snapshot", df)
+    return version
+
+def get_derived(df, worksheet_name, name, builder):
+    """
+    An index derived from a worksheet frame (duplicate clusters, search keys, ...), built at
+    most once per snapshot across all replicas and memoized in-process. Entries are tagged
+    with the frame's content digest, not just the version: the TTL reload can change the
+    data without a version bump. Fallback frames are never cached.
+    """
+    digest = df.attrs.get('snapshot')
+    if digest is None or df.attrs.get('stale'): return builder()
+    memo = get_derived_memo()
+    hit = memo.get((worksheet_name, name))
+    if hit and hit[0] == digest: return hit[1]
+    cache = get_shared_cache()
+    version = sheet_version(worksheet_name)
+    hit = cache.get(worksheet_name, version, name)
+    if hit and hit[0] == digest:
+        value = hit[1]
+    else:
+        value = builder()
+        cache.put(worksheet_name, version, name, (digest, value))
+    memo[(worksheet_name, name)] = (digest, value)
+    return value
+
+# ==========================================
+# 6. GMAIL CORRESPONDENCE INDEX
+# ==========================================
+# A per-user copy of message metadata, keyed by counterpart address, so the card, Inbox and
+# dashboard can answer "what did we exchange with this client" without querying Gmail.
+# The first sync lists the last GMAIL_INDEX_DAYS of mail; later ones replay users.history.
+GMAIL_INDEX_DAYS = 365
+GMAIL_SYNC_INTERVAL = 120  # seconds between background syncs per user
+GMAIL_SYNC_WORKERS = 4     # users syncing at once; the rest wait their turn
+GMAIL_INDEX_HEADERS = ['From', 'To', 'Cc', 'Subject', 'Date']
+GMAIL_BATCH_SIZE = 100     # messages.get calls per batch request (Gmail's maximum)
+
+class GmailIndex:
+    """One user's mail metadata, persisted in SQLite and mirrored in memory for lookups."""
+    def __init__(self, user_email, path):
+        self.user_email = user_email.lower()
+        self.path = path
+        self.lock = threading.Lock()
+        self.messages = {}      # id -> metadata dict
+        self.by_address = {}    # counterpart address -> set of message ids
+        self.last_inbound = {}  # counterpart address -> newest inbound timestamp (ms)
+        self.history_id = None
+        self.synced_at = None
+        self.attempted_at = 0.0
+        self.syncing = False
+        self.last_error = None
+        self.load()
+
+    @property
+    def ready(self):
+        return self.history_id is not None
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("CREATE TABLE IF NOT EXISTS messages (id TEXT PRIMARY KEY, ts INTEGER, direction TEXT, subject TEXT, date TEXT, snippet TEXT, addresses TEXT)")
+        conn.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)")
+        return conn
+
+    def load(self):
+        conn = self.connect()
+        try:
+            for msg_id, ts, direction, subject, date_str, snippet, addresses in conn.execute("SELECT * FROM messages"):
+                self.remember({'id': msg_id, 'ts': ts, 'direction': direction, 'subject': subject, 'date': date_str, 'snippet': snippet, 'addresses': addresses.split()})
+            state = dict(conn.execute("SELECT key, value FROM state"))
+            self.history_id = state.get('history_id')
+            if state.get('synced_at'): self.synced_at = float(state['synced_at'])
+        finally:
+            conn.close()
+
+    def remember(self, meta):
+        # Callers hold self.lock (or own the index exclusively, as in load)
+        self.messages[meta['id']] = meta
+        for addr in meta['addresses']:
+            self.by_address.setdefault(addr, set()).add(meta['id'])
+            if meta['direction'] == 'in' and meta['ts'] > self.last_inbound.get(addr, 0): self.last_inbound[addr] = meta['ts']
+
+    def forget(self, msg_id):
+        meta = self.messages.pop(msg_id, None)
+        if not meta: return
+        for addr in meta['addresses']:
+            ids = self.by_address.get(addr, set())
+            ids.discard(msg_id)
+            if meta['direction'] == 'in' and self.last_inbound.get(addr) == meta['ts']:
+                newest = max((self.messages[i]['ts'] for i in ids if self.messages[i]['direction'] == 'in'), default=0)
+                if newest: self.last_inbound[addr] = newest
+                else: self.last_inbound.pop(addr, None)
+
+    def apply(self, added, deleted, history_id=None):
+        """
+        Persists a batch of changes in one transaction, then updates the in-memory view.
+        Without a history_id the batch is progress only; the index isn't marked synced.
+        """
+        synced_at = time.time()
+        conn = self.connect()
+        try:
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                 [(m['id'], m['ts'], m['direction'], m['subject'], m['date'], m['snippet'], " ".join(m['addresses'])) for m in added])
+                conn.executemany("DELETE FROM messages WHERE id = ?", [(i,) for i in deleted])
+                if history_id is not None:
+                    conn.executemany("INSERT OR REPLACE INTO state VALUES (?, ?)", [('history_id', str(history_id)), ('synced_at', str(synced_at))])
+        finally:
+            conn.close()
+        with self.lock:
+            for msg_id in deleted: self.forget(msg_id)
+            for meta in added: self.remember(meta)
+            if history_id is not None:
+                self.history_id = str(history_id)
+                self.synced_at = synced_at
+
+    # --- Lookups (in memory) ---
+    def lookup(self, addresses, limit=10):
+        """Newest messages exchanged with any of the addresses, shaped like search_gmail_messages()."""
+        keys = [str(a).strip().lower() for a in addresses if a]
+        with self.lock:
+            metas = [self.messages[i] for i in set().union(*(self.by_address.get(k, ()) for k in keys))]
+        metas.sort(key=lambda m: m['ts'], reverse=True)
+        return [{'subject': m['subject'], 'date': m['date'], 'snippet': m['snippet']} for m in metas[:limit]]
+
+    def last_heard_from(self, addresses):
+        """Timestamp (ms) of the newest message received from any of the addresses, or 0."""
+        return max((self.last_inbound.get(str(a).strip().lower(), 0) for a in addresses if a), default=0)
+
+    def replied_since(self, since):
+        since_ms = since.timestamp() * 1000
+        with self.lock:
+            return {addr for addr, ts in self.last_inbound.items() if ts >= since_ms}
+
+    # --- Sync (background thread) ---
+    def fetch_metas(self, service, msg_ids):
+        """Metadata for msg_ids, GMAIL_BATCH_SIZE gets per batch request. Messages deleted since listing are skipped."""
+        msg_ids, metas = list(msg_ids), []
+        for start in range(0, len(msg_ids), GMAIL_BATCH_SIZE):
+            remaining, fetched = set(msg_ids[start:start + GMAIL_BATCH_SIZE]), {}
+
+            def run_batch():
+                failed = []
+                def collect(request_id, response, exception):
+                    if exception is None: fetched[request_id] = response
+                    elif api_error_status(exception) == 404: remaining.discard(request_id)  # Deleted since it was listed
+                    else: failed.append(exception)
+                batch = service.new_batch_http_request(callback=collect)
+                for msg_id in remaining - fetched.keys():
+                    batch.add(service.users().messages().get(userId='me', id=msg_id, format='metadata', metadataHeaders=GMAIL_INDEX_HEADERS), request_id=msg_id)
+                batch.execute()
+                # Throttled parts surface as one error so call_api backs off; the retry only re-sends those
+                if failed: raise failed[0]
+
+            call_api("gmail_batch", run_batch, user=self.user_email)
+            metas += [self.parse_meta(fetched[i]) for i in msg_ids[start:start + GMAIL_BATCH_SIZE] if i in fetched]
+        return metas
+
+    def parse_meta(self, m):
+        headers = {h['name']: h['value'] for h in m.get('payload', {}).get('headers', [])}
+        direction = 'out' if 'SENT' in m.get('labelIds', []) else 'in'
+        fields = ['To', 'Cc'] if direction == 'out' else ['From']
+        addresses = {addr.lower() for _, addr in getaddresses([headers.get(f, '') for f in fields]) if "@" in addr}
+        addresses.discard(self.user_email)
+        return {'id': m['id'], 'ts': int(m.get('internalDate', 0)), 'direction': direction,
+                'subject': headers.get('Subject', '(No Subject)'), 'date': headers.get('Date', ''),
+                'snippet': m.get('snippet', ''), 'addresses': sorted(addresses)}
+
+    def full_sync(self, service):
+        # Take the history id first so nothing that arrives mid-listing is missed next time
+        history_id = call_api("gmail_sync", lambda: service.users().getProfile(userId='me').execute(), user=self.user_email)['historyId']
+        seen, page = set(), None
+        while True:
+            resp = call_api("gmail_sync", lambda: service.users().messages().list(userId='me', q=f"newer_than:{GMAIL_INDEX_DAYS}d", maxResults=500, pageToken=page).execute(), user=self.user_email)
+            page_ids = [msg['id'] for msg in resp.get('messages', [])]
+            seen.update(page_ids)
+            added = self.fetch_metas(service, [i for i in page_ids if i not in self.messages])
+            # Save each page as it lands, so a failed pass resumes instead of refetching everything
+            self.apply(added, [])
+            page = resp.get('nextPageToken')
+            if not page: break
+        self.apply([], [i for i in list(self.messages) if i not in seen], history_id)
+
+    def incremental_sync(self, service):
+        added_ids, deleted, history_id, page = set(), set(), self.history_id, None
+        while True:
+            resp = call_api("gmail_sync", lambda: service.users().history().list(userId='me', startHistoryId=self.history_id, historyTypes=['messageAdded', 'messageDeleted'], pageToken=page).execute(), user=self.user_email)
+            for record in resp.get('history', []):
+                for item in record.get('messagesAdded', []):
+                    added_ids.add(item['message']['id']); deleted.discard(item['message']['id'])
+                for item in record.get('messagesDeleted', []):
+                    deleted.add(item['message']['id']); added_ids.discard(item['message']['id'])
+            history_id = resp.get('historyId', history_id)
+            page = resp.get('nextPageToken')
+            if not page: break
+        added = self.fetch_metas(service, [i for i in added_ids if i not in self.messages])
+        self.apply(added, deleted, history_id)
+
+    def sync(self, creds):
+        try:
+            service = discovery.build('gmail', 'v1', credentials=creds)
+            if self.ready:
+                try:
+                    self.incremental_sync(service)
+                except Exception as e:
+                    # Gmail only keeps about a week of history; an expired id means starting over
+                    if api_error_status(e) != 404: raise
+                    self.full_sync(service)
+            else:
+                self.full_sync(service)
+            self.last_error = None
+        except Exception as e:
+            self.last_error = str(e)
+        finally:
+            self.syncing = False
+
+@st.cache_resource
+def get_gmail_sync_executor():
+    return ThreadPoolExecutor(max_workers=GMAIL_SYNC_WORKERS, thread_name_prefix="gmail-sync")
+
+@st.cache_resource
+def get_gmail_indexes():
+    return {'lock': threading.Lock(), 'indexes': {}}
+
+def get_gmail_index(user_email):
+    registry = get_gmail_indexes()
+    with registry['lock']:
+        if user_email not in registry['indexes']:
+            name = hashlib.sha1(user_email.lower().encode()).hexdigest()[:16]
+            registry['indexes'][user_email] = GmailIndex(user_email, os.path.join(cache_dir(), f"gmail_{name}.sqlite3"))
+        return registry['indexes'][user_email]
+
+def ensure_gmail_sync():
+    """The signed-in user's index, starting a background sync if one is due."""
+    if "creds" not in st.session_state: return None
+    index = get_gmail_index(st.session_state.user_email)
+    with index.lock:
+        due = not index.syncing and time.time() - index.attempted_at > GMAIL_SYNC_INTERVAL
+        if due: index.syncing, index.attempted_at = True, time.time()
+    if due: get_gmail_sync_executor().submit(index.sync, st.session_state.creds)
+    return index
+
+# ==========================================
+# 7. DATABASE FUNCTIONS & HELPERS
 # ==========================================
 def normalize_phone(phone):
     if not phone: return ""
     return re.sub(r'\D', '', str(phone))
 
+def name_tokens(name):
+    """Lowercased word tokens of a name, as used by the reference matcher."""
+    if not isinstance(name, str) or not name: return set()
+    return set(re.findall(r'\w+', name.lower()))
+
 def get_db_client():
     if "connections" not in st.secrets:
         st.error("❌ Secrets missing.")
@@ -207,76 +742,122 @@ def get_db_client():
     if "private_key" in secrets_dict:
         secrets_dict["private_key"] = secrets_dict["private_key"].replace("\\n", "\n")
     scopes = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
-    creds = Credentials.from_service_account_info(secrets_dict, scopes=scopes)
+    creds = service_account.Credentials.from_service_account_info(secrets_dict, scopes=scopes)
     return gspread.authorize(creds)
 
-@st.cache_data(ttl=600) 
-def get_data(worksheet_name="Clients"):
+@st.cache_resource(ttl=3600)
+def get_spreadsheet():
+    client = get_db_client()
+    raw_input = st.secrets["connections"]["gsheets"]["spreadsheet"]
+    sheet_id = raw_input.replace("https://docs.google.com/spreadsheets/d/", "").split("/")[0].strip()
+    return call_api("sheets_read", lambda: client.open_by_key(sheet_id))
+
+def fetch_worksheet_values(worksheet_name):
+    """Raw cell values of a worksheet, or None if the tab doesn't exist."""
+    sh = get_spreadsheet()
     try:
-        client = get_db_client()
-        raw_input = st.secrets["connections"]["gsheets"]["spreadsheet"]
-        sheet_id = raw_input.replace("https://docs.google.com/spreadsheets/d/", "").split("/")[0].strip()
-        sh = client.open_by_key(sheet_id)
-        try:
-            ws = sh.worksheet(worksheet_name)
-        except:
-            if worksheet_name == "Templates": return pd.DataFrame(columns=['Type', 'Subject', 'Body'])
-            # If Reference is missing, return empty but don't crash
-            if worksheet_name == "Reference": return pd.DataFrame()
-            return pd.DataFrame()
-            
-        raw_data = ws.get_all_values()
-        if not raw_data: return pd.DataFrame()
+        ws = call_api("sheets_read", lambda: sh.worksheet(worksheet_name))
+    except gspread.exceptions.WorksheetNotFound:
+        return None
+    return call_api("sheets_read", ws.get_all_values)
+
+def frame_from_values(worksheet_name, raw_data):
+    if raw_data is None:
+        if worksheet_name == "Templates": return pd.DataFrame(columns=['Type', 'Subject', 'Body'])
+        # If Reference is missing, return empty but don't crash
+        if worksheet_name == "Reference": return pd.DataFrame()
+        return pd.DataFrame()
+    if not raw_data: return pd.DataFrame()
+    
+    headers = raw_data[0]
+    rows = raw_data[1:]
+    unique_headers = []
+    seen = {}
+    for h in headers:
+        clean_h = str(h).strip()
+        if clean_h in seen: seen[clean_h] += 1; unique_headers.append(f"{clean_h}_{seen[clean_h]}")
+        else: seen[clean_h] = 0; unique_headers.append(clean_h)
         
-        headers = raw_data[0]
-        rows = raw_data[1:]
-        unique_headers = []
-        seen = {}
-        for h in headers:
-            clean_h = str(h).strip()
-            if clean_h in seen: seen[clean_h] += 1; unique_headers.append(f"{clean_h}_{seen[clean_h]}")
-            else: seen[clean_h] = 0; unique_headers.append(clean_h)
-            
-        df = pd.DataFrame(rows, columns=unique_headers)
+    df = pd.DataFrame(rows, columns=unique_headers)
+    
+    if worksheet_name == "Clients":
+        # Map standard columns if they don't exist exactly
+        if 'Notes' not in df.columns:
+            # Try to find a history column
+            for c in df.columns:
+                if 'history' in c.lower() or 'note' in c.lower():
+                    df.rename(columns={c: 'Notes'}, inplace=True)
+                    break
         
-        if worksheet_name == "Clients":
-            # Map standard columns if they don't exist exactly
-            if 'Notes' not in df.columns:
-                # Try to find a history column
-                for c in df.columns:
-                    if 'history' in c.lower() or 'note' in c.lower():
-                        df.rename(columns={c: 'Notes'}, inplace=True)
-                        break
-            
-            required_cols = ['Status', 'Outcome', 'Internal_Flag', 'Notes', 'Last_Agent', 'Last_Updated', 'Gender', 'Spouse E-mail Address']
-            for col in required_cols:
-                if col not in df.columns: df[col] = ""
-            df['Status'] = df['Status'].replace("", "New")
-            
+        required_cols = ['Status', 'Outcome', 'Internal_Flag', 'Notes', 'Last_Agent', 'Last_Updated', 'Follow_Up', 'Gender', 'Spouse E-mail Address']
+        for col in required_cols:
+            if col not in df.columns: df[col] = ""
+        df['Status'] = df['Status'].replace("", "New")
+
+    # Identifies this exact content for derived indexes (see get_derived)
+    df.attrs['snapshot'] = hashlib.sha1(pickle.dumps(raw_data, protocol=pickle.HIGHEST_PROTOCOL)).hexdigest()
+    return df
+
+@st.cache_data(ttl=SNAPSHOT_TTL, max_entries=20)
+def load_worksheet(worksheet_name, version):
+    # Another replica may already have fetched this version
+    cache = get_shared_cache()
+    df = cache.get(worksheet_name, version, "snapshot", max_age=SNAPSHOT_TTL)
+    if df is not None: return df
+    # Identical reads from concurrent sessions share one Sheets request
+    raw_data = coalesced(("sheet", worksheet_name, version), lambda: fetch_worksheet_values(worksheet_name))
+    df = frame_from_values(worksheet_name, raw_data)
+    cache.put(worksheet_name, version, "snapshot", df)
+    return df
+
+def get_data(worksheet_name="Clients"):
+    """Cached worksheet frame. If Google keeps failing, serves the last good copy with a banner."""
+    last_good = get_api_state()['last_good']
+    try:
+        df = load_worksheet(worksheet_name, sheet_version(worksheet_name))
+        last_good[("sheet", worksheet_name)] = (df, datetime.datetime.now())
+        st.session_state.get('stale_sheets', set()).discard(worksheet_name)
         return df
     except Exception as e:
+        if ("sheet", worksheet_name) in last_good:
+            df, fetched_at = last_good[("sheet", worksheet_name)]
+            st.warning(f"⚠️ Google Sheets is busy. Showing {worksheet_name} data from {fetched_at:%H:%M}; it will refresh automatically.")
+            df = df.copy()
+            df.attrs['stale'] = True
+            st.session_state.setdefault('stale_sheets', set()).add(worksheet_name)
+            return df
         st.error(f"DB Error ({worksheet_name}): {e}")
         return pd.DataFrame()
 
+def is_stale(df, worksheet_name):
+    """True while df, or this run's read of the sheet, is a last-good copy. Writing it back would undo newer saves."""
+    return bool(df.attrs.get('stale')) or worksheet_name in st.session_state.get('stale_sheets', ())
+
 def update_data(df, worksheet_name="Clients"):
+    if is_stale(df, worksheet_name):
+        st.error(f"⚠️ {worksheet_name} is showing an older copy while Google Sheets is busy. Saving is paused so newer changes aren't overwritten; try again shortly.")
+        return False
     try:
-        client = get_db_client()
-        raw_input = st.secrets["connections"]["gsheets"]["spreadsheet"]
-        sheet_id = raw_input.replace("https://docs.google.com/spreadsheets/d/", "").split("/")[0].strip()
-        sh = client.open_by_key(sheet_id)
-        ws = sh.worksheet(worksheet_name)
-        ws.clear()
-        ws.update([df.columns.values.tolist()] + df.values.tolist())
-        get_data.clear()
+        sh = get_spreadsheet()
+        ws = call_api("sheets_read", lambda: sh.worksheet(worksheet_name))
+        values = [df.columns.values.tolist()] + df.values.tolist()
+        # Overwrite in place, then blank any leftover rows, so a failed write never leaves an empty sheet
+        call_api("sheets_write", lambda: ws.update(values))
+        if ws.row_count > len(values):
+            call_api("sheets_write", lambda: ws.batch_clear([f"{len(values) + 1}:{ws.row_count}"]))
+        # Sheets stores what we wrote as text; seed that as the new shared snapshot
+        publish_invalidation(worksheet_name, frame_from_values(worksheet_name, [[str(v) for v in row] for row in values]))
+        return True
     except Exception as e:
         st.error(f"Save Error: {e}")
+        return False
 
 def clean_text(text):
     if not text: return ""
     return str(text).title().strip()
 
 # ==========================================
-# 4. GAMIFICATION & STATS
+# 8. GAMIFICATION & STATS
 # ==========================================
 def render_gamification(df):
     today_str = datetime.datetime.now().strftime("%Y-%m-%d")
@@ -313,7 +894,7 @@ def render_gamification(df):
             st.caption("No calls yet today. Be the first!")
 
 # ==========================================
-# 5. LOGIC HELPERS
+# 9. LOGIC HELPERS
 # ==========================================
 def generate_greeting(style, first_name, last_name, gender):
     first_name = clean_text(first_name)
@@ -332,11 +913,550 @@ def generate_greeting(style, first_name, last_name, gender):
         return f"Dear {prefix} {last_name},"
 
 # ==========================================
-# 6. CLIENT CARD EDITOR
+# 10. TEMPLATE ENGINE
+# ==========================================
+# Templates are compiled once per Templates version into plain lists: literal text at even
+# positions, merge field names at odd ones. Rendering is then just a join, cheap enough to
+# personalize thousands of bodies in one call.
+MERGE_FIELDS = {
+    'greeting': "Greeting line, e.g. 'Dear Mr. Smith,'",
+    'first_name': "Recipient's first name",
+    'last_name': "Recipient's last name",
+    'full_name': "Recipient's first and last name",
+    'spouse_name': "The other spouse's first name",
+    'agent_name': "Your name",
+}
+PLACEHOLDER_RE = re.compile(r'\{(\w+)\}')
+
+def text_to_html(text):
+    return text.replace(chr(10), '<br>')
+
+def template_placeholders(text):
+    return PLACEHOLDER_RE.findall(str(text or ''))
+
+def unknown_placeholders(*texts):
+    return sorted({f for t in texts for f in template_placeholders(t) if f not in MERGE_FIELDS})
+
+def compile_parts(text, to_html=False):
+    parts = [""]
+    for i, piece in enumerate(PLACEHOLDER_RE.split(str(text or ''))):
+        if i % 2 and piece in MERGE_FIELDS: parts += [piece, ""]
+        elif i % 2: parts[-1] += "{" + piece + "}"  # Unknown placeholders stay as typed
+        else: parts[-1] += text_to_html(piece) if to_html else piece
+    return parts
+
+def compile_template(t_type, subject, body):
+    body = str(body or '')
+    # Templates without an explicit {greeting} get it on top, as they always have
+    if 'greeting' not in template_placeholders(body): body = "{greeting}\n\n" + body
+    return {
+        'type': t_type,
+        'digest': hashlib.sha1(f"{t_type}\0{subject}\0{body}".encode()).hexdigest(),  # keys prefetched drafts
+        'subject': compile_parts(subject),
+        'text': compile_parts(body),
+        'html': compile_parts(body, to_html=True),
+    }
+
+def compile_templates(templates):
+    """Type -> compiled template, first row winning for duplicate names."""
+    if templates.empty: return {}
+    return {t['Type']: compile_template(t['Type'], t['Subject'], t['Body'])
+            for t in templates.drop_duplicates('Type').to_dict('records')}
+
+def get_compiled_templates(templates):
+    return get_derived(templates, "Templates", "compiled", lambda: compile_templates(templates))
+
+def merge_context(first_name, last_name, spouse_name, gender, style, agent_name=""):
+    first_name, last_name, spouse_name = clean_text(first_name), clean_text(last_name), clean_text(spouse_name)
+    return {
+        'greeting': generate_greeting(style, first_name, last_name, gender),
+        'first_name': first_name,
+        'last_name': last_name,
+        'full_name': f"{first_name} {last_name}".strip(),
+        'spouse_name': spouse_name,
+        'agent_name': agent_name or "",
+    }
+
+def client_merge_context(client, target_code, gender, style, agent_name=""):
+    tp_first, tp_last = client.get('Taxpayer First Name'), client.get('Taxpayer last name')
+    sp_first, sp_last = client.get('Spouse First Name'), client.get('Spouse last name')
+    if target_code == "SP": return merge_context(sp_first, sp_last, tp_first, gender, style, agent_name)
+    return merge_context(tp_first, tp_last, sp_first, gender, style, agent_name)
+
+def join_parts(parts, values):
+    return "".join(values[p] if i % 2 else p for i, p in enumerate(parts))
+
+def render_template(compiled, context):
+    """Returns {'subject', 'text', 'html'}; merge values are HTML-escaped in the html body."""
+    escaped = {k: html.escape(v) for k, v in context.items()}
+    return {
+        'subject': join_parts(compiled['subject'], context),
+        'text': join_parts(compiled['text'], context),
+        'html': join_parts(compiled['html'], escaped),
+    }
+
+def render_batch(compiled, clients, target_code="TP", style="Formal", gender=None, agent_name=""):
+    """
+    Renders one template for many client records (dicts or a DataFrame) in a single pass.
+    gender=None uses each client's own Gender for taxpayers and "Unknown" for spouses.
+    """
+    if hasattr(clients, 'to_dict'): clients = clients.to_dict('records')
+    return [render_template(compiled, client_merge_context(c, target_code, gender or default_review_gender(c, target_code), style, agent_name))
+            for c in clients]
+
+# ==========================================
+# 11. DUPLICATE DETECTION
+# ==========================================
+# Rows sharing any blocking key are linked; connected rows form a cluster.
+# Each row only touches its own keys, so this stays near-linear in sheet size.
+DUP_MAX_BLOCK = 25  # Keys shared by more rows than this (office lines, etc.) are too generic to trust
+
+STATUS_RANK = {"New": 0, "Wrong Number": 1, "Left Message": 2, "Updated File": 3, "Talked": 4, "Manager Emailed": 5}
+OUTCOME_RANK = {"": 0, "Pending": 1, "Maybe": 2, "No": 3, "Yes": 4}
+
+def dedupe_keys(row):
+    keys = []
+    phone = normalize_phone(row.get('Home Telephone'))[-10:]
+    if len(phone) > 6: keys.append(("Phone", phone))
+    for col in ['Taxpayer E-mail Address', 'Spouse E-mail Address']:
+        email = str(row.get(col) or '').strip().lower()
+        if "@" in email: keys.append(("Email", email))
+    # Household members can appear under the joint name or either spouse's own name
+    for name in [row.get('Name'),
+                 f"{row.get('Taxpayer First Name') or ''} {row.get('Taxpayer last name') or ''}",
+                 f"{row.get('Spouse First Name') or ''} {row.get('Spouse last name') or ''}"]:
+        tokens = name_tokens(name)
+        if len(tokens) >= 2: keys.append(("Name", " ".join(sorted(tokens))))
+    return keys
+
+def find_duplicate_clusters(df):
+    """
+    Groups rows of the Clients frame that share a phone, email or name key.
+    Returns: list of {'rows': [index labels], 'reasons': [key types]}, largest first.
+    """
+    if df.empty: return []
+    labels = df.index.tolist()
+    parent = list(range(len(labels)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    blocks = {}
+    for pos, row in enumerate(df.to_dict('records')):
+        for key in set(dedupe_keys(row)):
+            blocks.setdefault(key, []).append(pos)
+
+    reasons = {}
+    for (kind, _), members in blocks.items():
+        if len(members) < 2 or len(members) > DUP_MAX_BLOCK: continue
+        root = find(members[0])
+        for m in members[1:]:
+            other = find(m)
+            if other != root: parent[other] = root
+        reasons.setdefault(members[0], set()).add(kind)
+
+    groups = {}
+    for pos in range(len(labels)):
+        groups.setdefault(find(pos), []).append(pos)
+
+    clusters = []
+    for members in groups.values():
+        if len(members) < 2: continue
+        kinds = set()
+        for m in members: kinds |= reasons.get(m, set())
+        clusters.append({'rows': [labels[m] for m in members], 'reasons': sorted(kinds)})
+    clusters.sort(key=lambda c: len(c['rows']), reverse=True)
+    return clusters
+
+def merge_duplicate_cluster(df, rows, keep, user_email):
+    """
+    Folds the duplicate rows into `keep`: Notes are concatenated, the most advanced
+    Status/Outcome wins, blank contact fields are filled in, and the duplicates are dropped.
+    Returns the merged frame; the caller writes it back once.
+    """
+    dupes = [r for r in rows if r != keep]
+    if not dupes: return df
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
+    merged = df.loc[keep].copy()
+    notes = str(merged.get('Notes', ''))
+
+    for r in dupes:
+        dup = df.loc[r]
+        dup_notes = str(dup.get('Notes', '')).strip()
+        notes += f"\n----------------------------------------\n[🧬 MERGED {dup.get('ID', '')}] {timestamp} {user_email}"
+        if dup_notes: notes += f"\n{dup_notes}"
+
+        if STATUS_RANK.get(dup['Status'], 0) > STATUS_RANK.get(merged['Status'], 0): merged['Status'] = dup['Status']
+        if OUTCOME_RANK.get(dup['Outcome'], 0) > OUTCOME_RANK.get(merged['Outcome'], 0): merged['Outcome'] = dup['Outcome']
+        if str(dup.get('Internal_Flag')) == 'TRUE': merged['Internal_Flag'] = 'TRUE'
+        if str(dup.get('Last_Updated', '')) > str(merged.get('Last_Updated', '')):
+            merged['Last_Updated'] = dup['Last_Updated']
+            merged['Last_Agent'] = dup['Last_Agent']
+
+        for col in df.columns:
+            if col in ('Notes', 'ID', 'Status', 'Outcome', 'Internal_Flag', 'Last_Updated', 'Last_Agent'): continue
+            if not str(merged.get(col, '')).strip() and str(dup.get(col, '')).strip():
+                merged[col] = dup[col]
+
+    merged['Notes'] = notes
+    out = df.drop(index=dupes)
+    out.loc[keep] = merged
+    return out
+
+# ==========================================
+# 12. SEARCH & RESULT LISTS
+# ==========================================
+RESULTS_PAGE_SIZE = 20
+# Lower tier = better match
+SEARCH_TIERS = ["ID", "Phone", "Name prefix", "Name", "Email", "Notes"]
+
+def build_search_index(df):
+    """Lowercased/normalized search columns for the Clients frame (one per sheet version)."""
+    emails = df['Taxpayer E-mail Address'].astype(str) + " " + df['Spouse E-mail Address'].astype(str)
+    return pd.DataFrame({
+        'id': df['ID'].astype(str).str.strip().str.lower(),
+        'phone': df['Home Telephone'].apply(normalize_phone),
+        'name': " " + df['Name'].astype(str).str.lower(),  # leading space makes word-prefix a plain substring test
+        'email': emails.str.lower(),
+        'notes': df['Notes'].astype(str).str.lower(),
+    }, index=df.index)
+
+def search_clients(df, query):
+    """
+    Index labels of the rows matching query, best first:
+    exact ID, phone, name prefix, name, email, then Notes hits.
+    """
+    q = query.strip().lower()
+    if not q or df.empty: return []
+    index = get_derived(df, "Clients", "search_index", lambda: build_search_index(df))
+    if not index.index.equals(df.index): index = build_search_index(df)
+
+    q_phone = normalize_phone(q)
+    tiers = [
+        index['id'] == q,
+        index['phone'].str.contains(q_phone, regex=False) if len(q_phone) > 4 else None,
+        index['name'].str.contains(" " + q, regex=False),
+        index['name'].str.contains(q, regex=False),
+        index['email'].str.contains(q, regex=False),
+        index['notes'].str.contains(q, regex=False),
+    ]
+    rank = pd.Series(len(tiers), index=index.index)
+    # Paint worst tier first so better tiers overwrite it
+    for tier in reversed(range(len(tiers))):
+        if tiers[tier] is not None: rank[tiers[tier]] = tier
+    hits = rank[rank < len(tiers)]
+    return hits.sort_values(kind='stable').index.tolist()
+
+def render_result_list(df, labels, key, query, render_row, page_size=RESULTS_PAGE_SIZE):
+    """Renders one page of ranked hits with a prev/next cursor; rows off the page build no widgets."""
+    total = len(labels)
+    if not total:
+        st.warning("No matches.")
+        return
+    # A new query starts back at page one
+    if st.session_state.get(f"{key}_query") != query:
+        st.session_state[f"{key}_query"] = query
+        st.session_state[f"{key}_page"] = 0
+    pages = (total - 1) // page_size + 1
+    page = min(st.session_state.get(f"{key}_page", 0), pages - 1)
+    start = page * page_size
+    end = min(start + page_size, total)
+
+    st.write(f"Found {total:,}" + (f" (showing {start + 1}–{end})" if pages > 1 else "") + ":")
+    for _, row in df.loc[labels[start:end]].iterrows():
+        render_row(row)
+
+    if pages > 1:
+        c_prev, c_page, c_next = st.columns([1, 2, 1])
+        if c_prev.button("◀ Prev", key=f"{key}_prev", disabled=page == 0):
+            st.session_state[f"{key}_page"] = page - 1
+            st.rerun()
+        c_page.caption(f"Page {page + 1} of {pages}")
+        if c_next.button("Next ▶", key=f"{key}_next", disabled=page >= pages - 1):
+            st.session_state[f"{key}_page"] = page + 1
+            st.rerun()
+
+# ==========================================
+# 13. FOLLOW-UP SCHEDULER
+# ==========================================
+# Callbacks live in the Follow_Up column as "YYYY-MM-DD HH:MM", which sorts the same as
+# time. The due index keeps them in ascending order (a valid min-heap), overall and per
+# agent, so the next callback is the head and "due by T" is one bisect.
+FOLLOW_UP_FORMAT = "%Y-%m-%d %H:%M"
+FOLLOW_UP_STATUSES = ("Left Message",)
+FOLLOW_UP_OUTCOMES = ("Maybe",)
+
+def build_follow_up_index(df):
+    """{agent or '*': {'times': [...], 'ids': [...]}} sorted by due time; '*' is the whole team."""
+    index = {}
+    when = pd.to_datetime(df['Follow_Up'], format=FOLLOW_UP_FORMAT, errors='coerce')
+    scheduled = when.notna()
+    due = when[scheduled].dt.strftime(FOLLOW_UP_FORMAT).sort_values(kind='stable')
+    for due, cid, agent in zip(due, df.loc[due.index, 'ID'], df.loc[due.index, 'Last_Agent']):
+        for bucket in ('*', agent):
+            entry = index.setdefault(bucket, {'times': [], 'ids': []})
+            entry['times'].append(due)
+            entry['ids'].append(cid)
+    return index
+
+def get_follow_up_index(df):
+    if df.empty or 'Follow_Up' not in df.columns: return {}
+    return get_derived(df, "Clients", "follow_ups", lambda: build_follow_up_index(df))
+
+def due_follow_ups(index, agent='*', until=None):
+    """Client IDs whose callback is due at or before `until` (default now), earliest first."""
+    entry = index.get(agent)
+    if not entry: return []
+    until = until or datetime.datetime.now()
+    return entry['ids'][:bisect.bisect_right(entry['times'], until.strftime(FOLLOW_UP_FORMAT))]
+
+def next_follow_up(index, agent='*'):
+    """(due time, client ID) of the earliest scheduled callback, or None."""
+    entry = index.get(agent)
+    if not entry: return None
+    return entry['times'][0], entry['ids'][0]
+
+# ==========================================
+# 14. REVIEW PIPELINE (ADMIN INBOX)
+# ==========================================
+REVIEW_PREFETCH = 3  # drafts rendered ahead of the client on screen
+
+def review_targets(df):
+    return (df['Outcome'] == 'Yes') & (df['Status'] != 'Manager Emailed')
+
+class ReviewQueue:
+    """
+    Ordered Inbox work queue of client IDs. Skip and complete are O(1); targets are only
+    recomputed when the sheet version changes. Rows are found by ID in the frame at hand,
+    since a reload can shift row labels without a version bump.
+    """
+    def __init__(self):
+        self.pending = {}
+        self.skipped = set()
+        self.done = set()
+        self.version = None
+
+    def sync(self, df, version):
+        if version == self.version: return
+        targets = df[review_targets(df)]
+        self.pending = dict.fromkeys(cid for cid in targets['ID'] if cid not in self.skipped and cid not in self.done)
+        self.version = version
+
+    def head(self, n=1):
+        return list(itertools.islice(self.pending, n))
+
+    def locate(self, df, client_id):
+        """Row label of a queued client in df, or None (dropping it) if it's gone or no longer waiting."""
+        hits = df.index[df['ID'] == client_id]
+        if len(hits) and df.at[hits[0], 'Outcome'] == 'Yes' and df.at[hits[0], 'Status'] != 'Manager Emailed':
+            return hits[0]
+        self.pending.pop(client_id, None)
+        return None
+
+    def rows(self, df, n=1):
+        """(client ID, row label) of the next n clients that are still waiting in df."""
+        found = []
+        for client_id in list(self.pending):
+            label = self.locate(df, client_id)
+            if label is not None: found.append((client_id, label))
+            if len(found) == n: break
+        return found
+
+    def skip(self, client_id):
+        self.pending.pop(client_id, None)
+        self.skipped.add(client_id)
+
+    def complete(self, client_id):
+        self.pending.pop(client_id, None)
+        self.done.add(client_id)
+
+    def reset_skipped(self):
+        self.skipped.clear()
+        self.version = None
+
+    def __len__(self):
+        return len(self.pending)
+
+@st.cache_resource
+def get_review_executor():
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="review")
+
+def default_review_gender(client, target_code):
+    gender = client.get('Gender', 'Unknown') if target_code == "TP" else "Unknown"
+    return gender if gender in ["Male", "Female", "Unknown"] else "Unknown"
+
+def prefetch_review_drafts(df, queue, compiled, agent_name):
+    """
+    Renders default drafts for the next few clients as one background batch and forgets
+    drafts for clients already handled or rendered from an older copy of the template.
+    """
+    drafts = st.session_state.setdefault('review_drafts', {})
+    rows = queue.rows(df, REVIEW_PREFETCH + 1)
+    upcoming = [cid for cid, _ in rows]
+    digest = compiled['digest']
+    for key in [k for k in drafts if k[0] not in upcoming or k[1] != digest]: del drafts[key]
+    # Plain dicts only: the worker thread must not touch the frame or st.*
+    clients = {cid: df.loc[label].to_dict() for cid, label in rows}
+    keys = {cid: (cid, digest, compiled['type'], "TP", default_review_gender(c, "TP"), "Formal") for cid, c in clients.items()}
+    missing = [cid for cid in upcoming if keys[cid] not in drafts]
+    if not missing: return
+    batch = get_review_executor().submit(render_batch, compiled, [clients[cid] for cid in missing], "TP", "Formal", None, agent_name)
+    for i, cid in enumerate(missing): drafts[keys[cid]] = (batch, i)
+
+def review_draft(client, compiled, target_code, gender, style, agent_name):
+    """The prefetched draft when the admin kept the defaults, otherwise rendered on the spot."""
+    hit = st.session_state.get('review_drafts', {}).get((client['ID'], compiled['digest'], compiled['type'], target_code, gender, style))
+    if hit is not None: return hit[0].result()[hit[1]]
+    return render_template(compiled, client_merge_context(client, target_code, gender, style, agent_name))
+
+# ==========================================
+# 15. EXPORTS & REPORTS
+# ==========================================
+# Exports run on a worker thread and stream to a file under the cache dir chunk by chunk,
+# so neither the filtered log nor the encoded file is ever held in memory whole.
+EXPORT_CHUNK_ROWS = 5000
+EXPORT_MAX_AGE = 3600  # seconds an export file is kept; they hold client names and phones
+EXPORT_COLUMNS = ['ID', 'Name', 'Home Telephone', 'Status', 'Outcome', 'Follow_Up', 'Last_Updated', 'Last_Agent']
+EXPORT_FORMATS = {"CSV": ("csv", "text/csv"), "Parquet": ("parquet", "application/octet-stream")}
+TALKED_STATUSES = ("Talked", "Manager Emailed")
+
+def build_agent_daily_summary(df):
+    """Calls, talk rate and Yes rate per agent per day, from each client's latest touch."""
+    worked = df[(df['Status'] != 'New') & (df['Last_Agent'] != '')]
+    summary = pd.DataFrame({
+        'Day': worked['Last_Updated'].str[:10],
+        'Agent': worked['Last_Agent'],
+        'Talked': worked['Status'].isin(TALKED_STATUSES),
+        'Yes': worked['Outcome'] == 'Yes',
+    }).groupby(['Day', 'Agent']).agg(Calls=('Talked', 'size'), Talked=('Talked', 'sum'), Yes=('Yes', 'sum')).reset_index()
+    summary['Talk_Rate'] = (summary['Talked'] / summary['Calls']).round(3)
+    summary['Yes_Rate'] = (summary['Yes'] / summary['Calls']).round(3)
+    return summary.sort_values(['Day', 'Agent'], ascending=[False, True], ignore_index=True)
+
+def get_agent_daily_summary(df):
+    return get_derived(df, "Clients", "agent_daily", lambda: build_agent_daily_summary(df))
+
+def activity_mask(df, start=None, end=None, agents=(), statuses=(), outcomes=()):
+    """Worked rows, optionally limited to a Last_Updated day range and to some agents/statuses/outcomes."""
+    mask = df['Status'] != 'New'
+    day = df['Last_Updated'].astype(str).str[:10]
+    if start: mask &= day >= start.isoformat()
+    if end: mask &= day <= end.isoformat()
+    if agents: mask &= df['Last_Agent'].isin(agents)
+    if statuses: mask &= df['Status'].isin(statuses)
+    if outcomes: mask &= df['Outcome'].isin(outcomes)
+    return mask
+
+@st.cache_resource
+def get_export_executor():
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="export")
+
+def export_dir():
+    path = os.path.join(cache_dir(), "exports")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def prune_exports():
+    """Deletes export files older than EXPORT_MAX_AGE, including ones left by abandoned sessions."""
+    cutoff = time.time() - EXPORT_MAX_AGE
+    for entry in os.scandir(export_dir()):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff: os.remove(entry.path)
+        except OSError:
+            pass  # Removed by another session in the meantime
+
+def write_export(df, labels, columns, fmt, path):
+    """Writes df.loc[labels, columns] to path in EXPORT_CHUNK_ROWS slices. Runs on the export executor."""
+    writer = None
+    with open(path, "wb") as out:
+        for start in range(0, max(len(labels), 1), EXPORT_CHUNK_ROWS):
+            chunk = df.loc[labels[start:start + EXPORT_CHUNK_ROWS], columns]
+            if fmt == "csv":
+                out.write(chunk.to_csv(index=False, header=start == 0).encode("utf-8"))
+            else:
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                if writer is None: writer = pq.ParquetWriter(out, table.schema)
+                writer.write_table(table)
+        if writer is not None: writer.close()
+    return {'path': path, 'rows': len(labels), 'bytes': os.path.getsize(path)}
+
+def start_export(df, labels, columns, fmt, name):
+    """Queues an export job for this session, replacing (and deleting) the previous one's file."""
+    previous = st.session_state.pop('export_job', None)
+    if previous and os.path.exists(previous['path']) and previous['future'].done():
+        os.remove(previous['path'])
+    prune_exports()
+    ext = EXPORT_FORMATS[fmt][0]
+    stamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    path = os.path.join(export_dir(), f"{hashlib.sha1(st.session_state.user_email.encode()).hexdigest()[:12]}_{stamp}.{ext}")
+    # get_data hands every rerun its own copy of the frame, so the worker can read it safely
+    future = get_export_executor().submit(write_export, df, list(labels), columns, ext, path)
+    st.session_state.export_job = {'future': future, 'path': path, 'fmt': fmt, 'file_name': f"{name}_{stamp}.{ext}"}
+
+def render_export_panel(df):
+    with st.expander("⬇️ Export Call Logs & Agent Reports"):
+        today = datetime.date.today()
+        c1, c2 = st.columns(2)
+        report = c1.radio("Report", ["Call Log", "Agent Daily Summary"], horizontal=True)
+        fmt = c2.radio("Format", list(EXPORT_FORMATS), horizontal=True)
+        days = st.date_input("Last Updated between", value=(today - datetime.timedelta(days=30), today))
+        start, end = (tuple(days) + (None, None))[:2]
+        c3, c4, c5 = st.columns(3)
+        agents = c3.multiselect("Agents", sorted(a for a in df['Last_Agent'].unique() if a))
+        statuses = c4.multiselect("Status", sorted(s for s in df['Status'].unique() if s != 'New'), disabled=report != "Call Log")
+        outcomes = c5.multiselect("Outcome", sorted(o for o in df['Outcome'].unique() if o), disabled=report != "Call Log")
+
+        if report == "Call Log":
+            source = df
+            labels = df.index[activity_mask(df, start, end, agents, statuses, outcomes)]
+            columns = [c for c in EXPORT_COLUMNS if c in df.columns]
+        else:
+            source = get_agent_daily_summary(df)
+            in_range = pd.Series(True, index=source.index)
+            if start: in_range &= source['Day'] >= start.isoformat()
+            if end: in_range &= source['Day'] <= end.isoformat()
+            if agents: in_range &= source['Agent'].isin(agents)
+            labels = source.index[in_range]
+            columns = list(source.columns)
+        st.caption(f"{len(labels):,} rows match.")
+
+        job = st.session_state.get('export_job')
+        running = bool(job) and not job['future'].done()
+        if st.button("📦 Start Export", disabled=running or not len(labels)):
+            start_export(source, labels, columns, fmt, report.lower().replace(" ", "_"))
+            st.rerun()
+
+        if job:
+            if running:
+                st.info("Export is running in the background…")
+                if st.button("🔄 Check Export"): st.rerun()
+            elif job['future'].exception():
+                st.error(f"Export failed: {job['future'].exception()}")
+            else:
+                result = job['future'].result()
+                if not os.path.exists(result['path']):
+                    st.caption("This export has expired. Start a new one.")
+                    return
+                with open(result['path'], "rb") as f:
+                    st.download_button(f"⬇️ Download {job['file_name']} ({result['rows']:,} rows, {result['bytes'] / 1024:,.0f} KB)",
+                                       f, file_name=job['file_name'], mime=EXPORT_FORMATS[job['fmt']][1])
+
+# ==========================================
+# 16. CLIENT CARD EDITOR
 # ==========================================
 def render_client_card_editor(df, df_ref, templates, client_id):
     # Isolate Client
-    idx = df.index[df['ID'] == client_id][0]
+    hits = df.index[df['ID'] == client_id]
+    if not len(hits):
+        st.warning("This client is no longer in the sheet.")
+        st.session_state.current_id = None
+        st.session_state.admin_current_id = None
+        if st.button("⬅️ Back"): st.rerun()
+        return
+    idx = hits[0]
     client = df.loc[idx]
     
     # ------------------------------------
@@ -404,13 +1524,11 @@ def render_client_card_editor(df, df_ref, templates, client_id):
                     real_phone_col = df_ref.columns[phone_col_idx]
                     real_name_col = df_ref.columns[name_col_idx]
                     
-                    client_name_str = str(client['Name']).lower()
-                    client_tokens = set(re.findall(r'\w+', client_name_str))
+                    client_tokens = name_tokens(str(client['Name']))
 
                     if client_tokens:
                         def check_token_match(ref_val):
-                            if not isinstance(ref_val, str): return False
-                            ref_tokens = set(re.findall(r'\w+', ref_val.lower()))
+                            ref_tokens = name_tokens(ref_val)
                             if not ref_tokens: return False
                             common = client_tokens.intersection(ref_tokens)
                             if len(common) >= 2: return True
@@ -447,15 +1565,21 @@ def render_client_card_editor(df, df_ref, templates, client_id):
 
         with tab_gmail_hist:
             # Feature #4: Unified-ish Inbox with Error Handling
-            st.caption("Searching your Gmail for correspondence with this client...")
             search_targets = []
             if new_tp_email: search_targets.append(new_tp_email)
             if new_sp_email: search_targets.append(new_sp_email)
+            gmail_index = ensure_gmail_sync()
             
             if not search_targets:
                 st.info("No email addresses on file to search.")
             else:
-                gmail_results, error_msg = search_gmail_messages(search_targets)
+                # Answer from the local index once it has synced; query Gmail live until then
+                if gmail_index and gmail_index.ready:
+                    st.caption(f"From your mail index (synced {datetime.datetime.fromtimestamp(gmail_index.synced_at):%H:%M})")
+                    gmail_results, error_msg = gmail_index.lookup(search_targets), None
+                else:
+                    st.caption("Searching your Gmail for correspondence with this client...")
+                    gmail_results, error_msg = search_gmail_messages(search_targets)
                 if error_msg:
                     if error_msg == "PERM_ERROR":
                         st.error("⚠️ Access Denied: We cannot read your emails yet.")
@@ -499,28 +1623,25 @@ def render_client_card_editor(df, df_ref, templates, client_id):
                         selected_email_address = list(email_targets.values())[0]
                         is_spouse_email = (selected_email_address == new_sp_email)
 
+                    compiled_templates = get_compiled_templates(templates)
                     ec1, ec2 = st.columns([1, 1])
-                    tmplt = ec1.selectbox("Template", templates['Type'].unique())
+                    tmplt = ec1.selectbox("Template", list(compiled_templates))
                     greeting_style = ec2.radio("Greeting Style", ["Casual", "Formal"], horizontal=True)
 
-                    if not templates.empty and tmplt:
-                        raw_body = templates[templates['Type'] == tmplt]['Body'].values[0]
-                        subj = templates[templates['Type'] == tmplt]['Subject'].values[0]
-                        
+                    if tmplt:
                         if is_spouse_email and new_sp_first:
-                            g_first, g_last = new_sp_first, new_sp_last
-                            g_gender = "Unknown" 
+                            context = merge_context(new_sp_first, new_sp_last, new_tp_first, "Unknown", greeting_style, st.session_state.get('user_name', ''))
                         else:
-                            g_first, g_last, g_gender = new_tp_first, new_tp_last, new_gender
-
-                        greeting_line = generate_greeting(greeting_style, g_first, g_last, g_gender)
-                        full_body_draft = f"{greeting_line}\n\n{raw_body}"
+                            context = merge_context(new_tp_first, new_tp_last, new_sp_first, new_gender, greeting_style, st.session_state.get('user_name', ''))
+                        draft = render_template(compiled_templates[tmplt], context)
+                        subj = draft['subject']
                         
-                        body_edit = st.text_area("Edit Message Body", value=full_body_draft, height=200)
+                        body_edit = st.text_area("Edit Message Body", value=draft['text'], height=200)
                         
-                        sig = get_user_signature()
+                        sig = get_session_signature()
                         final_text = body_edit
-                        final_html = f"{body_edit.replace(chr(10), '<br>')}<br><br>{sig}"
+                        body_html = draft['html'] if body_edit == draft['text'] else text_to_html(body_edit)
+                        final_html = f"{body_html}<br><br>{sig}"
                         
                         st.markdown("**Preview:**")
                         st.components.v1.html(final_html, height=200, scrolling=True)
@@ -542,6 +1663,19 @@ def render_client_card_editor(df, df_ref, templates, client_id):
         
         flag = st.checkbox("🚩 Internal Flag", value=(str(client.get('Internal_Flag')) == 'TRUE'))
 
+        current_follow_up = pd.to_datetime(client.get('Follow_Up', ''), format=FOLLOW_UP_FORMAT, errors='coerce')
+        wants_follow_up = res in FOLLOW_UP_STATUSES or dec in FOLLOW_UP_OUTCOMES
+        follow_up = None
+        if st.checkbox("📅 Schedule Callback", value=wants_follow_up):
+            # A callback being worked is already due; re-saving its old time would serve it right back
+            if pd.isna(current_follow_up) or current_follow_up <= datetime.datetime.now():
+                tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+                current_follow_up = datetime.datetime.combine(tomorrow, datetime.time(10, 0))
+            c_fu1, c_fu2 = st.columns(2)
+            fu_date = c_fu1.date_input("Callback Date", value=current_follow_up.date())
+            fu_time = c_fu2.time_input("Callback Time", value=current_follow_up.time())
+            follow_up = datetime.datetime.combine(fu_date, fu_time)
+
         # --- ACTIONS ---
         col_b1, col_b2 = st.columns([1,4])
         
@@ -550,7 +1684,7 @@ def render_client_card_editor(df, df_ref, templates, client_id):
             st.session_state.admin_current_id = None
             st.rerun()
 
-        if col_b2.button("💾 SAVE & FINISH", type="primary", use_container_width=True):
+        if col_b2.button("💾 SAVE & FINISH", type="primary", use_container_width=True, disabled=is_stale(df, "Clients")):
             # Prepare Update
             df.at[idx, 'Taxpayer First Name'] = new_tp_first
             df.at[idx, 'Spouse First Name'] = new_sp_first
@@ -563,6 +1697,7 @@ def render_client_card_editor(df, df_ref, templates, client_id):
             df.at[idx, 'Status'] = res
             df.at[idx, 'Outcome'] = dec
             df.at[idx, 'Internal_Flag'] = "TRUE" if flag else "FALSE"
+            df.at[idx, 'Follow_Up'] = follow_up.strftime(FOLLOW_UP_FORMAT) if follow_up else ""
             df.at[idx, 'Last_Agent'] = st.session_state.user_email
             df.at[idx, 'Last_Updated'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
             
@@ -598,7 +1733,7 @@ def render_client_card_editor(df, df_ref, templates, client_id):
             st.rerun()
 
 # ==========================================
-# 7. VIEW: TEAM MEMBER (LOBBY vs CARD)
+# 17. VIEW: TEAM MEMBER (LOBBY vs CARD)
 # ==========================================
 def render_team_view(df, df_ref, templates, user_email):
     if 'current_id' not in st.session_state: st.session_state.current_id = None
@@ -609,13 +1744,32 @@ def render_team_view(df, df_ref, templates, user_email):
         with col_queue:
             with st.container(border=True):
                 st.write("### 📞 Call Queue")
-                
+
+                # Callbacks that have come due go out before new leads, yours first
+                follow_ups = get_follow_up_index(df)
+                my_due = due_follow_ups(follow_ups, user_email)
+                team_due = due_follow_ups(follow_ups)
+                end_of_day = datetime.datetime.combine(datetime.date.today(), datetime.time.max)
+                today_count = len(due_follow_ups(follow_ups, user_email, until=end_of_day))
+                c_due, c_today = st.columns(2)
+                c_due.metric("☎️ Callbacks Due", len(my_due), help=f"{len(team_due)} due across the team")
+                c_today.metric("📅 My Callbacks Today", today_count)
+                if my_due or team_due:
+                    if st.button("☎️ NEXT CALLBACK", type="primary", use_container_width=True):
+                        # Team callbacks are drawn at random so idle agents don't all open the same client
+                        st.session_state.current_id = my_due[0] if my_due else random.choice(team_due)
+                        st.rerun()
+                else:
+                    upcoming = next_follow_up(follow_ups, user_email)
+                    if upcoming: st.caption(f"Next callback: {upcoming[0]}")
+                st.markdown("---")
+
                 # Exclude worked statuses
                 queue = df[df['Status'] == 'New']
                 st.metric("New Leads Remaining", len(queue))
                 
                 if not queue.empty:
-                    if st.button("🎲 START CALL (Prioritize Phones)", type="primary", use_container_width=True):
+                    if st.button("🎲 START CALL (Prioritize Phones)", type="secondary" if (my_due or team_due) else "primary", use_container_width=True):
                         queue['clean_phone'] = queue['Home Telephone'].apply(normalize_phone)
                         with_phone = queue[queue['clean_phone'].str.len() > 6]
                         no_phone = queue[queue['clean_phone'].str.len() <= 6]
@@ -635,35 +1789,19 @@ def render_team_view(df, df_ref, templates, user_email):
                 st.write("### 🔎 Find Client (Deep Search)")
                 search = st.text_input("Search Name, Phone, Email, or Notes")
                 if search:
-                    search_norm = normalize_phone(search)
-                    df['search_phone'] = df['Home Telephone'].apply(normalize_phone)
-                    
-                    mask = (
-                        df['Name'].astype(str).str.contains(search, case=False, na=False) |
-                        df['Taxpayer E-mail Address'].astype(str).str.contains(search, case=False, na=False) |
-                        df['Notes'].astype(str).str.contains(search, case=False, na=False)
-                    )
-                    
-                    if len(search_norm) > 4:
-                        mask = mask | df['search_phone'].str.contains(search_norm, na=False)
-                    
-                    res = df[mask]
-
-                    if not res.empty:
-                        st.write(f"Found {len(res)}:")
-                        for i, row in res.iterrows():
-                            c1, c2 = st.columns([3, 1])
-                            c1.text(f"{row['Name']} | {row['Home Telephone']} | {row['Status']}")
-                            if c2.button("LOAD", key=f"load_{row['ID']}"):
-                                st.session_state.current_id = row['ID']
-                                st.rerun()
-                    else:
-                        st.warning("No matches.")
+                    def lobby_row(row):
+                        c1, c2 = st.columns([3, 1])
+                        c1.text(f"{row['Name']} | {row['Home Telephone']} | {row['Status']}")
+                        if c2.button("LOAD", key=f"load_{row['ID']}"):
+                            st.session_state.current_id = row['ID']
+                            st.rerun()
+
+                    render_result_list(df, search_clients(df, search), "lobby_results", search, lobby_row)
     else:
         render_client_card_editor(df, df_ref, templates, st.session_state.current_id)
 
 # ==========================================
-# 8. VIEW: TEMPLATE MANAGER
+# 18. VIEW: TEMPLATE MANAGER
 # ==========================================
 def render_template_manager():
     st.subheader("📝 Template Manager")
@@ -682,7 +1820,10 @@ def render_template_manager():
                 t_type = st.text_input("Template Name (Type)")
                 t_subj = st.text_input("Subject Line")
                 t_body = st.text_area("Body Content (HTML Allowed)", height=300)
-                if st.button("Create Template"):
+                st.caption("Merge fields: " + ", ".join(f"`{{{f}}}`" for f in MERGE_FIELDS))
+                bad_fields = unknown_placeholders(t_subj, t_body)
+                if bad_fields: st.error(f"Unknown merge field(s): {', '.join('{' + f + '}' for f in bad_fields)}")
+                if st.button("Create Template", disabled=bool(bad_fields) or is_stale(df_temp, "Templates")):
                     if t_type and t_subj:
                         new_row = pd.DataFrame([[t_type, t_subj, t_body]], columns=['Type', 'Subject', 'Body'])
                         updated_df = pd.concat([df_temp, new_row], ignore_index=True)
@@ -697,30 +1838,44 @@ def render_template_manager():
                 t_edit, t_prev = st.tabs(["✏️ Edit HTML", "👁️ Live Preview"])
                 with t_edit:
                     new_body = st.text_area("Body Content", value=current_row['Body'], height=300)
+                    st.caption("Merge fields: " + ", ".join(f"`{{{f}}}`" for f in MERGE_FIELDS))
+                bad_fields = unknown_placeholders(new_subj, new_body)
+                if bad_fields: st.error(f"Unknown merge field(s): {', '.join('{' + f + '}' for f in bad_fields)}")
                 with t_prev:
-                    st.html(f"<div style='background:#f9f9f9; padding:15px; border:1px solid #ddd;'>{new_body.replace(chr(10), '<br>')}</div>")
+                    sample = render_template(compile_template(selected_option, new_subj, new_body),
+                                             merge_context("Jane", "Doe", "John", "Female", "Formal", st.session_state.get('user_name', '')))
+                    st.write(f"**Subject:** {sample['subject']}")
+                    st.html(f"<div style='background:#f9f9f9; padding:15px; border:1px solid #ddd;'>{sample['html']}</div>")
 
-                if st.button("Update Template", type="primary"):
+                if st.button("Update Template", type="primary", disabled=bool(bad_fields) or is_stale(df_temp, "Templates")):
                     df_temp.at[idx, 'Subject'] = new_subj
                     df_temp.at[idx, 'Body'] = new_body
                     update_data(df_temp, "Templates")
                     st.success("Updated!")
 
 # ==========================================
-# 9. VIEW: ADMIN DASHBOARD
+# 19. VIEW: ADMIN DASHBOARD
 # ==========================================
 def render_admin_view(df, df_ref, templates, user_email):
     st.title("🔒 Admin Dashboard")
     
-    c1, c2, c3, c4 = st.columns(4)
+    gmail_index = ensure_gmail_sync()
+    c1, c2, c3, c4, c5 = st.columns(5)
     c1.metric("Total Clients", len(df))
     c2.metric("Calls Made", len(df[df['Status'] != 'New']))
     c3.metric("Pending", len(df[df['Outcome'].isin(['Pending', 'Maybe'])]))
     c4.metric("Success", len(df[df['Outcome'] == 'Yes']))
+    if gmail_index and gmail_index.ready:
+        replied = gmail_index.replied_since(datetime.datetime.now() - datetime.timedelta(days=7))
+        replied_mask = (df['Taxpayer E-mail Address'].astype(str).str.strip().str.lower().isin(replied) |
+                        df['Spouse E-mail Address'].astype(str).str.strip().str.lower().isin(replied))
+        c5.metric("📨 Replied This Week", int(replied_mask.sum()))
+    else:
+        c5.metric("📨 Replied This Week", "…", help="Your mail index is still syncing.")
     st.markdown("---")
     
     if "admin_nav" not in st.session_state: st.session_state.admin_nav = "📥 Inbox"
-    nav_options = ["📊 Activity", "📥 Inbox", "🔍 Database (Fix)", "📝 Templates"]
+    nav_options = ["📊 Activity", "📥 Inbox", "🔍 Database (Fix)", "🧬 Duplicates", "📝 Templates"]
     
     selected_view = st.radio("Admin Navigation", nav_options, index=nav_options.index(st.session_state.admin_nav), horizontal=True, label_visibility="collapsed", key="admin_nav_radio", on_change=lambda: st.session_state.update(admin_nav=st.session_state.admin_nav_radio))
     st.session_state.admin_nav = selected_view
@@ -728,33 +1883,43 @@ def render_admin_view(df, df_ref, templates, user_email):
 
     if selected_view == "📊 Activity":
         st.subheader("All Call Logs")
+        render_export_panel(df)
         activity = df[df['Status'] != 'New'].sort_values(by='Last_Updated', ascending=False)
         st.dataframe(activity[['Name', 'Status', 'Outcome', 'Last_Updated', 'Last_Agent']], use_container_width=True)
 
+        st.subheader("Agent Daily Summary")
+        st.dataframe(get_agent_daily_summary(df), hide_index=True, use_container_width=True)
+
     elif selected_view == "📥 Inbox":
-        if "skipped_ids" not in st.session_state: st.session_state.skipped_ids = []
-        targets = df[(df['Outcome'] == 'Yes') & (df['Status'] != 'Manager Emailed')]
-        targets = targets[~targets['ID'].isin(st.session_state.skipped_ids)]
+        if "review_queue" not in st.session_state: st.session_state.review_queue = ReviewQueue()
+        queue = st.session_state.review_queue
+        queue.sync(df, sheet_version("Clients"))
+        head = queue.rows(df)  # Also drops queued clients this frame no longer has waiting
         
         col_header, col_mode = st.columns([2, 1])
-        with col_header: st.subheader(f"Waiting for Manager Email ({len(targets)})")
+        with col_header: st.subheader(f"Waiting for Manager Email ({len(queue)})")
         with col_mode: rapid_mode = st.toggle("⚡ Rapid Review Mode", value=True)
 
-        if targets.empty:
+        if not len(queue):
             st.success("🎉 Inbox Zero!")
-            if st.session_state.skipped_ids and st.button("Reset Skipped Clients"):
-                st.session_state.skipped_ids = []
+            if queue.skipped and st.button("Reset Skipped Clients"):
+                queue.reset_skipped()
                 st.rerun()
         else:
+            template_map = get_compiled_templates(templates)
+            agent_name = st.session_state.get('user_name', '')
+            if template_map and rapid_mode: prefetch_review_drafts(df, queue, next(iter(template_map.values())), agent_name)
+
             current_client = None
             if rapid_mode:
-                current_client = targets.iloc[0]
+                if head: current_client = df.loc[head[0][1]]
             else:
                 col_list, col_compose = st.columns([1, 1.5])
                 with col_list:
+                    targets = df[df['ID'].isin(list(queue.pending)) & review_targets(df)]
                     event = st.dataframe(targets[['Name', 'Home Telephone', 'Outcome']], on_select="rerun", selection_mode="single-row", use_container_width=True, height=700)
                     if len(event.selection.rows) > 0:
-                        current_client = df[df['ID'] == targets.iloc[event.selection.rows[0]]['ID']].iloc[0]
+                        current_client = targets.iloc[event.selection.rows[0]]
 
             if current_client is not None:
                 container = st.container() if rapid_mode else col_compose
@@ -762,12 +1927,13 @@ def render_admin_view(df, df_ref, templates, user_email):
                     if rapid_mode: st.info(f"⚡ processing **{current_client['Name']}**")
                     with st.container(border=True):
                         tp_name = clean_text(current_client.get('Taxpayer First Name'))
-                        tp_last = clean_text(current_client.get('Taxpayer last name'))
                         tp_email = str(current_client.get('Taxpayer E-mail Address', '')).strip()
                         sp_name = clean_text(current_client.get('Spouse First Name'))
-                        sp_last = clean_text(current_client.get('Spouse last name'))
                         sp_email = str(current_client.get('Spouse E-mail Address', '')).strip()
 
+                        heard_ms = gmail_index.last_heard_from([tp_email, sp_email]) if gmail_index and gmail_index.ready else 0
+                        if heard_ms: st.caption(f"📨 Last email from this client: {datetime.datetime.fromtimestamp(heard_ms / 1000):%Y-%m-%d %H:%M}")
+
                         target_map = {"TP": f"Taxpayer: {tp_name}", "SP": f"Spouse: {sp_name}"}
                         options = [target_map["TP"]]
                         if sp_name: options.append(target_map["SP"])
@@ -776,44 +1942,39 @@ def render_admin_view(df, df_ref, templates, user_email):
                         is_spouse = (selected_label == target_map.get("SP"))
                         
                         if is_spouse:
-                            target_code, f_name, l_name, selected_email_addr, db_gender = "SP", sp_name, sp_last, sp_email, "Unknown"
+                            target_code, f_name, selected_email_addr = "SP", sp_name, sp_email
                         else:
-                            target_code, f_name, l_name, selected_email_addr, db_gender = "TP", tp_name, tp_last, tp_email, current_client.get('Gender', 'Unknown')
+                            target_code, f_name, selected_email_addr = "TP", tp_name, tp_email
+                        db_gender = default_review_gender(current_client, target_code)
                             
                         if not selected_email_addr: st.error(f"❌ No email found for {selected_label}.")
-                        if db_gender not in ["Male", "Female", "Unknown"]: db_gender = "Unknown"
 
                         c_g1, c_g2 = st.columns(2)
                         conf_gender = c_g1.selectbox("Gender", ["Male", "Female", "Unknown"], index=["Male", "Female", "Unknown"].index(db_gender), key=f"gender_{current_client['ID']}")
                         greeting_style = c_g2.radio("Style", ["Casual", "Formal"], index=1, horizontal=True, key=f"greet_{current_client['ID']}")
 
-                        if not templates.empty:
-                            t_options = templates['Type'].unique().tolist()
+                        if template_map:
+                            t_options = list(template_map)
                             selected_template = st.selectbox("Template", t_options, index=0, key=f"temp_{current_client['ID']}")
-                            t_row = templates[templates['Type'] == selected_template].iloc[0]
-                            
-                            greeting_line = f"Hi {f_name}," if greeting_style == "Casual" else f"Dear {f_name} {l_name},"
-                            if greeting_style == "Formal":
-                                if conf_gender == "Male": greeting_line = f"Dear Mr. {l_name},"
-                                elif conf_gender == "Female": greeting_line = f"Dear Ms. {l_name},"
-
-                            full_body = f"{greeting_line}\n\n{t_row['Body']}"
-                            subj = t_row['Subject']
+                            draft = review_draft(current_client, template_map[selected_template], target_code, conf_gender, greeting_style, agent_name)
                             
-                            final_subj = st.text_input("Subject", value=subj, key=f"subj_{current_client['ID']}")
-                            final_text = st.text_area("Body", value=full_body, height=300, key=f"body_{current_client['ID']}")
+                            final_subj = st.text_input("Subject", value=draft['subject'], key=f"subj_{current_client['ID']}")
+                            final_text = st.text_area("Body", value=draft['text'], height=300, key=f"body_{current_client['ID']}")
                             new_note = st.text_area("Internal Note", height=70, key=f"note_{current_client['ID']}")
 
                             col_send, col_skip = st.columns([2,1])
                             btn_label = "🚀 SEND & NEXT" if rapid_mode else "🚀 SEND & ARCHIVE"
                             
-                            if col_send.button(btn_label, type="primary", use_container_width=True, key=f"btn_send_{current_client['ID']}"):
+                            if col_send.button(btn_label, type="primary", use_container_width=True, key=f"btn_send_{current_client['ID']}", disabled=is_stale(df, "Clients")):
+                                # Write to the row that has this client's ID now, never a remembered position
+                                idx = queue.locate(df, current_client['ID'])
                                 if not selected_email_addr: st.error("No email!")
+                                elif idx is None: st.error("This client changed in the sheet. Please refresh before sending.")
                                 else:
-                                    sig = get_user_signature()
-                                    final_html = f"{final_text.replace(chr(10), '<br>')}<br><br>{sig}"
+                                    sig = get_session_signature()
+                                    body_html = draft['html'] if final_text == draft['text'] else text_to_html(final_text)
+                                    final_html = f"{body_html}<br><br>{sig}"
                                     if send_email_as_user(selected_email_addr, final_subj, final_text, final_html):
-                                        idx = df.index[df['ID'] == current_client['ID']][0]
                                         df.at[idx, 'Status'] = "Manager Emailed"
                                         if target_code == "TP": df.at[idx, 'Gender'] = conf_gender
                                         
@@ -823,13 +1984,14 @@ def render_admin_view(df, df_ref, templates, user_email):
                                         log_entry = f"\n[{timestamp} {st.session_state.user_email}]: {new_note}\n----------------\n[📧 MANAGER EMAIL SENT] {timestamp}\nTo: {selected_email_addr}"
                                         df.at[idx, 'Notes'] = f"{existing_notes}{log_entry}"
 
-                                        update_data(df, "Clients")
-                                        st.toast(f"✅ Sent to {f_name}!")
-                                        time.sleep(0.5)
-                                        st.rerun()
+                                        if update_data(df, "Clients"):
+                                            queue.complete(current_client['ID'])
+                                            st.toast(f"✅ Sent to {f_name}!")
+                                            time.sleep(0.5)
+                                            st.rerun()
                             
                             if col_skip.button("⏭️ SKIP", key=f"btn_skip_{current_client['ID']}"):
-                                st.session_state.skipped_ids.append(current_client['ID'])
+                                queue.skip(current_client['ID'])
                                 st.rerun()
 
     elif selected_view == "🔍 Database (Fix)":
@@ -839,37 +2001,48 @@ def render_admin_view(df, df_ref, templates, user_email):
             st.write("### 🔎 List")
             search_query = st.text_input("Search", key="admin_search_query")
             if search_query:
-                # Same robust search logic as Lobby
-                search_norm = normalize_phone(search_query)
-                df['search_phone'] = df['Home Telephone'].apply(normalize_phone)
-                
-                mask = (
-                    df['Name'].astype(str).str.contains(search_query, case=False, na=False) |
-                    df['Taxpayer E-mail Address'].astype(str).str.contains(search_query, case=False, na=False) |
-                    df['Notes'].astype(str).str.contains(search_query, case=False, na=False)
-                )
-                if len(search_norm) > 4:
-                    mask = mask | df['search_phone'].str.contains(search_norm, na=False)
-                    
-                res = df[mask]
-                if not res.empty:
-                    for i, row in res.iterrows():
-                        with st.container(border=True):
-                            st.markdown(f"**{row['Name']}**\n{row['Home Telephone']}")
-                            if st.button("EDIT", key=f"admin_load_{row['ID']}", use_container_width=True):
-                                st.session_state.admin_current_id = row['ID']
-                else:
-                    st.warning("No matches.")
+                # Same ranked search as the Lobby
+                def admin_row(row):
+                    with st.container(border=True):
+                        st.markdown(f"**{row['Name']}**\n{row['Home Telephone']}")
+                        if st.button("EDIT", key=f"admin_load_{row['ID']}", use_container_width=True):
+                            st.session_state.admin_current_id = row['ID']
+
+                render_result_list(df, search_clients(df, search_query), "admin_results", search_query, admin_row)
         with col_admin_edit:
             st.write("### 📝 Editor")
             if st.session_state.get('admin_current_id'):
                 render_client_card_editor(df, df_ref, templates, st.session_state.admin_current_id)
 
+    elif selected_view == "🧬 Duplicates":
+        st.subheader("Possible Duplicate Households")
+        clusters = get_derived(df, "Clients", "duplicates", lambda: find_duplicate_clusters(df))
+        if not clusters:
+            st.success("🎉 No duplicates found!")
+        else:
+            st.caption(f"Found {len(clusters)} clusters covering {sum(len(c['rows']) for c in clusters)} rows. Showing the largest 20.")
+            show_cols = [c for c in ['ID', 'Name', 'Home Telephone', 'Taxpayer E-mail Address', 'Spouse E-mail Address', 'Status', 'Outcome', 'Last_Updated'] if c in df.columns]
+            for cluster in clusters[:20]:
+                rows = [r for r in cluster['rows'] if r in df.index]
+                if len(rows) < 2: continue
+                members = df.loc[rows]
+                cluster_key = members.iloc[0]['ID']
+                with st.expander(f"{members.iloc[0]['Name']} — {len(rows)} rows (matched on {', '.join(cluster['reasons'])})"):
+                    st.dataframe(members[show_cols], hide_index=True, use_container_width=True)
+                    keep_id = st.radio("Keep record:", members['ID'].tolist(), horizontal=True, key=f"dup_keep_{cluster_key}")
+                    if st.button("🧬 MERGE CLUSTER", type="primary", key=f"dup_merge_{cluster_key}", disabled=is_stale(df, "Clients")):
+                        keep = members.index[members['ID'] == keep_id][0]
+                        merged_df = merge_duplicate_cluster(df, rows, keep, st.session_state.user_email)
+                        with st.spinner("Saving to Google Sheets..."):
+                            update_data(merged_df, "Clients")
+                        st.toast(f"✅ Merged {len(rows)} rows into {keep_id}")
+                        st.rerun()
+
     elif selected_view == "📝 Templates":
         render_template_manager()
 
 # ==========================================
-# 10. MAIN ROUTER
+# 20. MAIN ROUTER
 # ==========================================
 if not authenticate_user():
     c1, c2, c3 = st.columns([1,2,1])
@@ -888,9 +2061,24 @@ else:
         st.caption(f"Role: {role}")
         
         if st.button("🔄 Refresh Data"):
-            get_data.clear()
-            st.cache_data.clear()
-            st.rerun()
+            api_state = get_api_state()
+            since = time.monotonic() - api_state['last_refresh']
+            if since < REFRESH_COOLDOWN:
+                st.toast(f"Data was refreshed {int(since)}s ago. Try again shortly.")
+            else:
+                api_state['last_refresh'] = time.monotonic()
+                for name in CACHED_SHEETS: publish_invalidation(name)
+                st.cache_data.clear()
+                st.rerun()
+
+        if role == "Admin":
+            with st.expander("⏱️ Import Costs"):
+                costs = get_import_costs()
+                if not costs: st.caption("No deferred modules loaded yet.")
+                for name, ms in sorted(costs.items(), key=lambda kv: -kv[1]):
+                    budget = IMPORT_BUDGET_MS.get(name)
+                    flag = "⚠️" if budget and ms > budget else "✅"
+                    st.caption(f"{flag} `{name}` {ms:.0f} ms" + (f" (budget {budget} ms)" if budget else ""))
 
         st.markdown("---")
         if st.button("Logout"):
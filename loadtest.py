@@ -0,0 +1,368 @@
+"""
+Multi-agent load test for app.py.
+
+Drives the real script with Streamlit's AppTest, one AppTest per simulated agent, against
+in-memory stand-ins for Google Sheets and Gmail (with configurable latency). Each agent
+loops through the Lobby: START CALL, edit and SAVE the card, then a deep search.
+
+    python loadtest.py --agents 20 --iterations 5 --clients 2000 --latency 0.15
+
+Reports per-action latency percentiles, Sheets/Gmail calls per action, session memory and
+lost updates (a save that silently reverted another agent's saved row).
+
+Running many AppTests in one process relies on Streamlit internals (see
+allow_concurrent_apptests), so the harness only runs on the Streamlit release pinned in
+requirements.txt (STREAMLIT_TESTED) and stops with a clear message on any other.
+"""
+import argparse
+import collections
+import os
+import pickle
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+import gspread
+import googleapiclient.discovery
+from google.oauth2 import service_account
+from unittest.mock import MagicMock
+
+import streamlit
+
+STREAMLIT_TESTED = "1.66."  # release series the private hooks below were written against
+if not streamlit.__version__.startswith(STREAMLIT_TESTED):
+    sys.exit(f"loadtest.py needs Streamlit {STREAMLIT_TESTED}x (found {streamlit.__version__}); "
+             "it patches Streamlit internals. Install the version pinned in requirements.txt.")
+try:
+    from streamlit.components.v2.component_manager import BidiComponentManager
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+    from streamlit.runtime.dataframe_source_manager import DataframeSourceManager
+    from streamlit.runtime.media_file_manager import MediaFileManager
+    from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    from streamlit.testing.v1 import AppTest
+except ImportError as e:
+    sys.exit(f"loadtest.py: Streamlit internals it depends on have moved ({e}).")
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+HEADERS = ['ID', 'Name', 'Home Telephone', 'Taxpayer First Name', 'Taxpayer last name', 'Spouse First Name',
+           'Spouse last name', 'Taxpayer E-mail Address', 'Spouse E-mail Address', 'Gender', 'Status', 'Outcome',
+           'Internal_Flag', 'Notes', 'Last_Agent', 'Last_Updated']
+FIRST_NAMES = ["James", "Mary", "John", "Linda", "Robert", "Susan", "David", "Karen", "Ali", "Sara", "Omid", "Nina"]
+LAST_NAMES = ["Smith", "Johnson", "Brown", "Garcia", "Miller", "Davis", "Kohani", "Rahimi", "Lee", "Clark"]
+
+# ==========================================
+# CALL ACCOUNTING
+# ==========================================
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = collections.Counter()  # (agent, kind) -> count
+        self.latency = collections.defaultdict(list)  # action -> [seconds]
+        self.action_calls = collections.defaultdict(collections.Counter)  # action -> kind -> count
+        self.errors = collections.Counter()
+        self.lost_updates = 0
+
+    def count(self, kind):
+        with self.lock: self.calls[(current_agent(), kind)] += 1
+
+    def snapshot(self, agent):
+        with self.lock: return {kind: n for (a, kind), n in self.calls.items() if a == agent}
+
+STATS = Stats()
+
+def current_agent():
+    # Calls made on a script thread belong to that session's agent; anything else is background work
+    ctx = get_script_run_ctx(suppress_warning=True)
+    if ctx is None: return "background"
+    try: return ctx.session_state["user_email"]
+    except KeyError: return "background"
+
+# ==========================================
+# FAKE GOOGLE SERVICES
+# ==========================================
+class FakeWorksheet:
+    def __init__(self, values, latency):
+        self.values = [list(r) for r in values]
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.row_authors = {}  # row ID -> (agent who last changed it, row before that change)
+
+    @property
+    def row_count(self):
+        return max(len(self.values), 1000)
+
+    def get_all_values(self):
+        STATS.count("sheets_read")
+        time.sleep(self.latency)
+        with self.lock: return [list(r) for r in self.values]
+
+    def update(self, values, *args, **kwargs):
+        STATS.count("sheets_write")
+        time.sleep(self.latency)
+        agent = current_agent()
+        incoming = [[str(v) for v in row] for row in values]
+        with self.lock:
+            self.detect_lost_updates(agent, incoming)
+            self.values = incoming + self.values[len(incoming):]
+
+    def batch_clear(self, ranges):
+        STATS.count("sheets_write")
+        time.sleep(self.latency)
+        first_row = int(ranges[0].split(":")[0])
+        with self.lock: self.values = self.values[:first_row - 1]
+
+    def clear(self):
+        STATS.count("sheets_write")
+        with self.lock: self.values = []
+
+    def detect_lost_updates(self, agent, incoming):
+        if not self.values or self.values[0][:1] != ['ID']: return
+        current = {row[0]: row for row in self.values[1:]}
+        for row in incoming[1:]:
+            old = current.get(row[0])
+            if old is None or old == row: continue
+            author, before = self.row_authors.get(row[0], (None, None))
+            # Writing back exactly what another agent had just replaced means their save was lost
+            if author not in (None, agent) and row == before:
+                with STATS.lock: STATS.lost_updates += 1
+            self.row_authors[row[0]] = (agent, old)
+
+class FakeSpreadsheet:
+    def __init__(self, sheets, latency):
+        self.sheets = sheets
+        self.latency = latency
+
+    def worksheet(self, name):
+        STATS.count("sheets_read")
+        time.sleep(self.latency / 2)
+        if name not in self.sheets: raise gspread.exceptions.WorksheetNotFound(name)
+        return self.sheets[name]
+
+class FakeSheetsClient:
+    def __init__(self, spreadsheet):
+        self.spreadsheet = spreadsheet
+
+    def open_by_key(self, key):
+        STATS.count("sheets_read")
+        return self.spreadsheet
+
+class FakeRequest:
+    def __init__(self, kind, result, latency):
+        self.kind, self.result, self.latency = kind, result, latency
+
+    def execute(self):
+        STATS.count(self.kind)
+        time.sleep(self.latency)
+        return self.result
+
+class FakeBatch:
+    """One round trip for all the requests added to it, like a Gmail batch request."""
+    def __init__(self, callback, latency):
+        self.callback, self.latency, self.requests = callback, latency, []
+
+    def add(self, request, request_id=None):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        time.sleep(self.latency)
+        for request_id, request in self.requests:
+            STATS.count(request.kind)
+            self.callback(request_id, request.result, None)
+
+class FakeGmail:
+    """Enough of the Gmail v1 surface for the app: sendAs, messages, history, profile and batches."""
+    def __init__(self, latency):
+        self.latency = latency
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(callback, self.latency)
+
+    def users(self): return self
+    def settings(self): return self
+    def sendAs(self): return self
+    def messages(self): return self
+    def history(self): return self
+    def userinfo(self): return self
+
+    def list(self, **kwargs):
+        if 'startHistoryId' in kwargs: return FakeRequest("gmail_read", {'history': [], 'historyId': kwargs['startHistoryId']}, self.latency)
+        if 'q' in kwargs: return FakeRequest("gmail_read", {'messages': []}, self.latency)
+        return FakeRequest("gmail_read", {'sendAs': [{'isPrimary': True, 'signature': '<i>Kohani & Co.</i>'}]}, self.latency)
+
+    def get(self, **kwargs):
+        return FakeRequest("gmail_read", {'id': kwargs.get('id'), 'internalDate': '0', 'payload': {'headers': []}}, self.latency)
+
+    def getProfile(self, **kwargs):
+        return FakeRequest("gmail_read", {'historyId': '1'}, self.latency)
+
+    def send(self, **kwargs):
+        return FakeRequest("gmail_send", {'id': 'sent'}, self.latency)
+
+class FakeCredentials:
+    expired = False
+    refresh_token = None
+
+def make_sheets(n_clients, latency, seed):
+    rng = random.Random(seed)
+    rows = [HEADERS]
+    for i in range(n_clients):
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        phone = f"({rng.randint(200, 999)}) {rng.randint(200, 999)}-{rng.randint(0, 9999):04d}" if rng.random() < 0.8 else ""
+        rows.append([str(1000 + i), f"{first} {last}", phone, first, last, "", "",
+                     f"{first}.{last}{i}@example.com".lower(), "", rng.choice(["Male", "Female", ""]),
+                     "New", rng.choice(["", "", "", "Yes"]), "", "", "", ""])
+    templates = [['Type', 'Subject', 'Body'], ['Follow Up', 'Checking in, {first_name}', 'Thanks for speaking with us today.\n\nBest,\n{agent_name}']]
+    return {
+        "Clients": FakeWorksheet(rows, latency),
+        "Templates": FakeWorksheet(templates, latency),
+        "Reference": FakeWorksheet([['Name', 'Phone']], latency),
+    }
+
+def allow_concurrent_apptests():
+    """
+    AppTest assumes one test at a time: every run installs a mock Runtime singleton and
+    clears it afterwards. Pin one shared mock instead, like a real server's single Runtime,
+    and serialize script compilation (CPython's parser isn't safe across threads).
+    """
+    for owner, attr in [(Runtime, "instance"), (Runtime, "exists"), (ScriptCache, "get_bytecode")]:
+        if not callable(getattr(owner, attr, None)):
+            sys.exit(f"loadtest.py: {owner.__name__}.{attr} is gone; this Streamlit isn't supported.")
+    runtime = MagicMock(spec=Runtime)
+    runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/mock/media"))
+    runtime.dataframe_source_mgr = DataframeSourceManager()
+    runtime.cache_storage_manager = MemoryCacheStorageManager()
+    runtime.bidi_component_registry = BidiComponentManager()
+    Runtime.instance = classmethod(lambda cls: runtime)
+    Runtime.exists = classmethod(lambda cls: True)
+
+    compile_lock = threading.Lock()
+    get_bytecode = ScriptCache.get_bytecode
+    def locked_get_bytecode(self, script_path):
+        with compile_lock: return get_bytecode(self, script_path)
+    ScriptCache.get_bytecode = locked_get_bytecode
+
+def install_fakes(sheets, latency):
+    spreadsheet = FakeSpreadsheet(sheets, latency)
+    gspread.authorize = lambda creds: FakeSheetsClient(spreadsheet)
+    service_account.Credentials.from_service_account_info = staticmethod(lambda info, scopes=None: None)
+    googleapiclient.discovery.build = lambda *args, **kwargs: FakeGmail(latency)
+
+# ==========================================
+# AGENTS
+# ==========================================
+def new_session(agent, cache_dir, timeout):
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    at.secrets['connections'] = {'gsheets': {'spreadsheet': 'loadtest', 'private_key': 'x'}}
+    at.secrets['client'] = {'client_id': 'x', 'client_secret': 'x', 'auth_uri': 'https://x', 'token_uri': 'https://x', 'redirect_uri': 'https://x'}
+    at.secrets['cache'] = {'dir': cache_dir}
+    at.session_state['creds'] = FakeCredentials()
+    at.session_state['user_email'] = agent
+    at.session_state['user_name'] = agent.split("@")[0].title()
+    return at
+
+def find_button(at, prefix):
+    return next((b for b in at.button if b.label.startswith(prefix)), None)
+
+def timed(agent, action, step):
+    before = STATS.snapshot(agent)
+    start = time.perf_counter()
+    try:
+        step()
+    except Exception as e:
+        with STATS.lock: STATS.errors[f"{action}: {type(e).__name__}"] += 1
+        return
+    elapsed = time.perf_counter() - start
+    after = STATS.snapshot(agent)
+    with STATS.lock:
+        STATS.latency[action].append(elapsed)
+        for kind in set(before) | set(after):
+            STATS.action_calls[action][kind] += after.get(kind, 0) - before.get(kind, 0)
+
+def run_agent(agent, args, barrier, sessions):
+    rng = random.Random(agent)
+    at = new_session(agent, args.cache_dir, args.timeout)
+    sessions.append(at)
+    barrier.wait()
+    timed(agent, "open_lobby", lambda: at.run())
+
+    for _ in range(args.iterations):
+        start_call = find_button(at, "🎲 START CALL")
+        if start_call is None: break  # Queue empty
+        timed(agent, "start_call", lambda: start_call.click().run())
+
+        def save():
+            for box in at.selectbox:
+                if box.label == "Call Result": box.set_value(rng.choice(["Talked", "Left Message", "Wrong Number"]))
+                if box.label == "Decision": box.set_value(rng.choice(["Yes", "No", "Maybe"]))
+            for area in at.text_area:
+                if area.label == "Add Note": area.set_value(f"load test note from {agent}")
+            find_button(at, "💾 SAVE").click().run()
+        if find_button(at, "💾 SAVE") is not None: timed(agent, "save", save)
+
+        term = rng.choice([rng.choice(LAST_NAMES), rng.choice(FIRST_NAMES).lower(), str(rng.randint(200, 999))])
+        search_box = next((t for t in at.text_input if t.label.startswith("Search Name")), None)
+        if search_box is not None: timed(agent, "deep_search", lambda: search_box.set_value(term).run())
+
+def session_bytes(at):
+    total = 0
+    for _, value in at.session_state.items():
+        try: total += len(pickle.dumps(value))
+        except Exception: pass
+    return total
+
+# ==========================================
+# REPORT
+# ==========================================
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def report(args, sessions, wall, rss_before, rss_after):
+    print(f"\n{args.agents} agents x {args.iterations} iterations over {args.clients} clients "
+          f"({args.latency * 1000:.0f} ms simulated Google latency) in {wall:.1f}s\n")
+    kinds = ["sheets_read", "sheets_write", "gmail_read", "gmail_send"]
+    print(f"{'action':<12} {'n':>5} {'p50':>8} {'p90':>8} {'p99':>8} {'max':>8}  " + "  ".join(f"{k + '/act':>17}" for k in kinds))
+    for action, values in STATS.latency.items():
+        per = STATS.action_calls[action]
+        print(f"{action:<12} {len(values):>5} " + " ".join(f"{percentile(values, p) * 1000:>7.0f}ms" for p in (50, 90, 99, 100))
+              + "  " + "  ".join(f"{per.get(k, 0) / len(values):>17.2f}" for k in kinds))
+
+    background = {kind: n for (agent, kind), n in STATS.calls.items() if agent == "background"}
+    if background: print(f"\nBackground calls (sync/prefetch threads): {dict(background)}")
+    sizes = [session_bytes(at) for at in sessions]
+    if sizes: print(f"Session state: avg {sum(sizes) / len(sizes) / 1024:.1f} KB, max {max(sizes) / 1024:.1f} KB (picklable values)")
+    # ru_maxrss is KB on Linux
+    print(f"Process peak RSS grew {(rss_after - rss_before) / 1024:.1f} MB (~{(rss_after - rss_before) / 1024 / max(args.agents, 1):.1f} MB per session)")
+    print(f"Lost updates (saves that reverted another agent's row): {STATS.lost_updates}")
+    if STATS.errors: print(f"Errors: {dict(STATS.errors)}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--agents", type=int, default=20)
+    parser.add_argument("--iterations", type=int, default=3, help="Lobby -> card -> save -> search loops per agent")
+    parser.add_argument("--clients", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=0.1, help="Seconds added to every fake Google call")
+    parser.add_argument("--timeout", type=float, default=120, help="Seconds allowed per script run")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args(argv)
+    args.cache_dir = tempfile.mkdtemp(prefix="kohani_loadtest_")
+
+    install_fakes(make_sheets(args.clients, args.latency, args.seed), args.latency)
+    allow_concurrent_apptests()
+    barrier = threading.Barrier(args.agents)
+    sessions = []
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    threads = [threading.Thread(target=run_agent, args=(f"agent{i:02d}@kohani.com", args, barrier, sessions)) for i in range(args.agents)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    report(args, sessions, time.perf_counter() - start, rss_before, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+if __name__ == "__main__":
+    sys.exit(main())
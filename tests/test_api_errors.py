@@ -0,0 +1,59 @@
+import ast
+import pathlib
+import socket
+
+import httplib2
+import requests
+from googleapiclient.errors import HttpError
+from gspread.exceptions import APIError
+
+APP = pathlib.Path(__file__).resolve().parent.parent / "app.py"
+
+
+def load_functions(*names):
+    """Compiles just the named top-level functions from app.py; importing it would run the Streamlit page."""
+    tree = ast.parse(APP.read_text())
+    nodes = [n for n in tree.body if isinstance(n, ast.FunctionDef) and n.name in names]
+    ns = {}
+    exec(compile(ast.Module(body=nodes, type_ignores=[]), str(APP), "exec"), ns)
+    return ns
+
+
+api_error_status = load_functions("api_error_status")["api_error_status"]
+
+
+def gspread_error(status):
+    resp = requests.Response()
+    resp.status_code = status
+    resp._content = b'{"error": {"code": %d, "message": "quota", "status": "RESOURCE_EXHAUSTED"}}' % status
+    return APIError(resp)
+
+
+def google_error(status):
+    return HttpError(httplib2.Response({"status": status}), b"{}")
+
+
+def test_gspread_429_is_detected():
+    e = gspread_error(429)
+    assert not e.response  # error responses are falsy, which used to hide the status
+    assert api_error_status(e) == 429
+
+
+def test_gspread_server_error_is_detected():
+    assert api_error_status(gspread_error(503)) == 503
+
+
+def test_googleapiclient_429_is_detected():
+    assert api_error_status(google_error(429)) == 429
+
+
+def test_non_http_errors_have_no_status():
+    assert api_error_status(socket.timeout()) is None
+    assert api_error_status(requests.exceptions.ConnectionError()) is None
+    assert api_error_status(ValueError("boom")) is None
+
+
+def test_network_errors_are_oserrors():
+    # call_api retries anything that is an OSError when retry_server_errors is set
+    assert isinstance(requests.exceptions.ConnectionError(), OSError)
+    assert isinstance(socket.timeout(), OSError)